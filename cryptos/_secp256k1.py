@@ -0,0 +1,32 @@
+"""
+Optional bridge to libsecp256k1 (the C library Bitcoin Core uses) through the
+coincurve package. Nothing in cryptos requires it: the pure Python code stays
+the reference implementation and is used whenever coincurve is not installed.
+If it is installed, sign / verify / PublicKey.from_sk hand the elliptic curve
+math over to it, which is orders of magnitude faster.
+"""
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+AVAILABLE = coincurve is not None
+
+# -----------------------------------------------------------------------------
+# all inputs/outputs are plain ints or bytes so that this module does not need
+# to know anything about Point, PublicKey or Signature
+
+def sk_to_pk(sk: int) -> tuple[int, int]:
+    """ return the affine (x, y) of sk * G, requires 1 <= sk < n """
+    b = coincurve.PrivateKey(sk.to_bytes(32, 'big')).public_key.format(compressed=False)
+    return int.from_bytes(b[1:33], 'big'), int.from_bytes(b[33:65], 'big')
+
+def sign(sk: int, z: int) -> bytes:
+    """ sign the 32-byte message hash z, return the DER encoded (low-s) signature """
+    return coincurve.PrivateKey(sk.to_bytes(32, 'big')).sign(z.to_bytes(32, 'big'), hasher=None)
+
+def verify(x: int, y: int, z: int, der: bytes) -> bool:
+    """ verify the DER encoded signature of message hash z against public key (x, y) """
+    sec = b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+    return coincurve.PublicKey(sec).verify(der, z.to_bytes(32, 'big'), hasher=None)
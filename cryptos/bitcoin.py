@@ -3,7 +3,7 @@ Bitcoin-specific functions, classes, utilities and parameters
 """
 
 from dataclasses import dataclass
-from .curves import Curve, Point, Generator
+from .curves import Curve, Point, Generator, Endomorphism
 
 # -----------------------------------------------------------------------------
 # public API
@@ -25,7 +25,18 @@ def bitcoin_gen():
     Gx = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
     Gy = 0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8
     n = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
-    curve = Curve(p, a, b)
+    # secp256k1 has a = 0 and p = 1 (mod 3), so it comes with the GLV endomorphism
+    # phi(x, y) = (beta * x, y) = lam * (x, y), constants as in libsecp256k1
+    endo = Endomorphism(
+        beta = 0x7AE96A2B657C07106E64479EAC3434E99CF0497512F58995C1396C28719501EE,
+        lam = 0x5363AD4CC05C30E0A5261C028812645A122E22EA20816678DF02967C1B23BD72,
+        n = n,
+        a1 = 0x3086D221A7D46BCDE86C90E49284EB15,
+        b1 = -0xE4437ED6010E88286F547FA90ABFE4C3,
+        a2 = 0x114CA50F7A8E2F3F657C1108D9D44CFD8,
+        b2 = 0x3086D221A7D46BCDE86C90E49284EB15,
+    )
+    curve = Curve(p, a, b, endo)
     G = Point(curve, Gx, Gy)
     gen = Generator(G, n)
     return gen
@@ -6,10 +6,12 @@ Reference:
 """
 
 from __future__ import annotations # PEP 563: Postponed Evaluation of Annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Tuple, Union
 
-from .sha256 import sha256
+import struct
+
+from .sha256 import hash256, sha256d_64
 
 # -----------------------------------------------------------------------------
 # Block headers, 80 bytes
@@ -17,9 +19,17 @@ GENESIS_BLOCK = {
     'main': bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c'),
     'test': bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae18'),
 }
+# target of the genesis block, i.e. of difficulty 1
+_GENESIS_TARGET = 0xffff << (8 * (0x1d - 3))
+
 # -----------------------------------------------------------------------------
 # helper functions
 
+# the fixed layout 80 byte header goes through struct in one call, which is cheaper
+# than reading / writing (and int.from_bytes / to_bytes-ing) it field by field:
+# version, prev_block, merkle_root, timestamp, bits, nonce
+_HEADER = struct.Struct('<I32s32sI4s4s')
+
 def decode_int(s, nbytes, encoding='little'):
     return int.from_bytes(s.read(nbytes), encoding)
 
@@ -29,7 +39,9 @@ def encode_int(i, nbytes, encoding='little'):
 def bits_to_target(bits):
     exponent = bits[-1]
     coeff = int.from_bytes(bits[:-1], 'little')
-    target = coeff * 256**(exponent - 3)
+    # i.e. coeff * 256**(exponent - 3), but as a plain shift instead of a big int pow
+    shift = 8 * (exponent - 3)
+    target = coeff << shift if shift >= 0 else coeff >> -shift
     return target
 
 def target_to_bits(target):
@@ -52,13 +64,29 @@ def calculate_new_bits(prev_bits, dt):
     dt = max(min(dt, two_weeks*4), two_weeks//4)
     prev_target = bits_to_target(prev_bits)
     new_target = int(prev_target * dt / two_weeks)
-    new_target = min(new_target, 0xffff * 256**(0x1d - 3)) # cap maximum target
+    new_target = min(new_target, _GENESIS_TARGET) # cap maximum target
     new_bits = target_to_bits(new_target)
     return new_bits
 
+def merkle_root(hashes: list) -> bytes:
+    """
+    Returns the Merkle root of a list of (32 byte) hashes, e.g. the txids of
+    the transactions in a block. Both in and out are in the internal byte
+    order, i.e. reversed w.r.t. the usual hex display. A level with an odd
+    number of hashes has its last one paired with itself, as Bitcoin does.
+    Every level is hashed in one batch, all its inputs are exactly 64 bytes.
+    """
+    assert len(hashes) > 0
+    level = list(hashes)
+    while len(level) > 1:
+        if len(level) & 1:
+            level.append(level[-1])
+        level = sha256d_64([level[i] + level[i+1] for i in range(0, len(level), 2)])
+    return level[0]
+
 # -----------------------------------------------------------------------------
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Block:
     version: int        # 4 bytes little endian
     prev_block: bytes   # 32 bytes, little endian
@@ -66,36 +94,36 @@ class Block:
     timestamp: int      # uint32, seconds since 1970-01-01T00:00 UTC
     bits: bytes         # 4 bytes, current target in compact format
     nonce: bytes        # 4 bytes, searched over in pow
+    # lazily computed and cached, the block is frozen so they can never go stale
+    _id: str = field(default=None, init=False, repr=False, compare=False)
+    _target: int = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def decode(cls, s) -> Block:
-        version = decode_int(s, 4)
-        prev_block = s.read(32)[::-1]
-        merkle_root = s.read(32)[::-1]
-        timestamp = decode_int(s, 4)
-        bits = s.read(4)
-        nonce = s.read(4)
-        return cls(version, prev_block, merkle_root, timestamp, bits, nonce)
+        return cls.from_bytes(s.read(_HEADER.size))
+
+    @classmethod
+    def from_bytes(cls, b) -> Block:
+        """ decode from the 80 header bytes b (bytes or memoryview) with a single unpack """
+        version, prev_block, merkle_root, timestamp, bits, nonce = _HEADER.unpack(b)
+        return cls(version, prev_block[::-1], merkle_root[::-1], timestamp, bits, nonce)
 
     def encode(self) -> bytes:
-        out = []
-        out += [encode_int(self.version, 4)]
-        out += [self.prev_block[::-1]]
-        out += [self.merkle_root[::-1]]
-        out += [encode_int(self.timestamp, 4)]
-        out += [self.bits]
-        out += [self.nonce]
-        return b''.join(out)
+        return _HEADER.pack(self.version, self.prev_block[::-1], self.merkle_root[::-1],
+                            self.timestamp, self.bits, self.nonce)
 
     def id(self) -> str:
-        return sha256(sha256(self.encode()))[::-1].hex()
+        if self._id is None:
+            object.__setattr__(self, '_id', hash256(self.encode())[::-1].hex())
+        return self._id
 
     def target(self) -> int:
-        return bits_to_target(self.bits)
+        if self._target is None:
+            object.__setattr__(self, '_target', bits_to_target(self.bits))
+        return self._target
 
     def difficulty(self) -> float:
-        genesis_block_target = 0xffff * 256**(0x1d - 3)
-        diff = genesis_block_target / self.target()
+        diff = _GENESIS_TARGET / self.target()
         return diff
 
     def validate(self) -> bool:
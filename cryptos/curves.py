@@ -5,12 +5,20 @@ addition and scalar multiplication.
 """
 
 from __future__ import annotations # PEP 563: Postponed Evaluation of Annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+# optional: if gmpy2 is installed the Jacobian kernels below reduce mod a GMP
+# integer, which makes every intermediate a GMP integer too, and those are
+# some 3x faster than CPython ints at 256 bits. Results are always plain ints.
+try:
+    from gmpy2 import mpz as _field_int
+except ImportError:
+    _field_int = int
 
 # -----------------------------------------------------------------------------
 # public API
 
-__all__ = ['Curve', 'Point', 'Generator']
+__all__ = ['Curve', 'Point', 'Generator', 'Endomorphism']
 
 # -----------------------------------------------------------------------------
 # Related math utilities
@@ -33,13 +41,262 @@ def extended_euclidean_algorithm(a, b):
     return old_r, old_s, old_t
 
 def inv(n, p):
-    """ returns modular multiplicate inverse m s.t. (n * m) % p == 1 """
-    gcd, x, y = extended_euclidean_algorithm(n, p) # pylint: disable=unused-variable
-    return x % p
+    """
+    returns modular multiplicate inverse m s.t. (n * m) % p == 1
+    Same result as running extended_euclidean_algorithm(n, p) above, but
+    Python 3.8+ does this natively in C with pow, which is a lot faster.
+    """
+    return pow(n, -1, p)
+
+def _add(P, Q, a, p):
+    """
+    Adds two affine points given as raw (x, y) tuples on the curve with
+    parameters a and p. None stands in for the point at infinity.
+    """
+    if P is None:
+        return Q
+    if Q is None:
+        return P
+    x1, y1 = P
+    x2, y2 = Q
+    # handle special case of P + (-P) = 0
+    if x1 == x2 and y1 != y2:
+        return None
+    # compute the "slope"
+    if x1 == x2: # (y1 = y2 is guaranteed too per above check)
+        m = (3 * x1**2 + a) * inv(2 * y1, p)
+    else:
+        m = (y1 - y2) * inv(x1 - x2, p)
+    # compute the new point
+    rx = (m**2 - x1 - x2) % p
+    ry = (-(m*(rx - x1) + y1)) % p
+    return rx, ry
+
+# -----------------------------------------------------------------------------
+# Jacobian coordinates: (X, Y, Z) represents the affine point (X/Z^2, Y/Z^3),
+# which lets us add and double without any modular inverse in between.
+# Z = 0 is the point at infinity.
+# Reference: https://hyperelliptic.org/EFD/g1p/auto-shortw-jacobian.html
+
+_JAC_INF = (1, 1, 0)
+
+def _jac_double(P, a, p):
+    """ doubles the Jacobian point P, dbl-2009-l if a = 0 (e.g. secp256k1) else dbl-2007-bl """
+    X1, Y1, Z1 = P
+    if Z1 == 0 or Y1 == 0:
+        return _JAC_INF
+    XX = X1 * X1 % p
+    YY = Y1 * Y1 % p
+    YYYY = YY * YY % p
+    S = 2 * ((X1 + YY)**2 - XX - YYYY) % p
+    if a == 0:
+        # no need to ever compute Z1^2
+        M = 3 * XX % p
+        Z3 = 2 * Y1 * Z1 % p
+    else:
+        ZZ = Z1 * Z1 % p
+        M = (3 * XX + a * ZZ * ZZ) % p
+        Z3 = ((Y1 + Z1)**2 - YY - ZZ) % p
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * YYYY) % p
+    return X3, Y3, Z3
+
+def _jac_add(P, Q, a, p):
+    """ add-2007-bl, adds the Jacobian points P and Q """
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if Z1 == 0:
+        return Q
+    if Z2 == 0:
+        return P
+    Z1Z1 = Z1 * Z1 % p
+    Z2Z2 = Z2 * Z2 % p
+    U1 = X1 * Z2Z2 % p
+    U2 = X2 * Z1Z1 % p
+    S1 = Y1 * Z2 * Z2Z2 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+    H = (U2 - U1) % p
+    r = 2 * (S2 - S1) % p
+    if H == 0:
+        # same x coordinate: either P == Q or P == -Q
+        return _jac_double(P, a, p) if r == 0 else _JAC_INF
+    I = (2 * H)**2 % p
+    J = H * I % p
+    V = U1 * I % p
+    X3 = (r * r - J - 2 * V) % p
+    Y3 = (r * (V - X3) - 2 * S1 * J) % p
+    Z3 = ((Z1 + Z2)**2 - Z1Z1 - Z2Z2) * H % p
+    return X3, Y3, Z3
+
+def _jac_add_affine(P, Q, a, p):
+    """ madd-2007-bl, adds the Jacobian point P and the affine point Q = (x, y), i.e. Z2 = 1 """
+    X1, Y1, Z1 = P
+    X2, Y2 = Q
+    if Z1 == 0:
+        return X2, Y2, 1
+    Z1Z1 = Z1 * Z1 % p
+    U2 = X2 * Z1Z1 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+    H = (U2 - X1) % p
+    r = 2 * (S2 - Y1) % p
+    if H == 0:
+        # same x coordinate: either P == Q or P == -Q
+        return _jac_double(P, a, p) if r == 0 else _JAC_INF
+    HH = H * H % p
+    I = 4 * HH % p
+    J = H * I % p
+    V = X1 * I % p
+    X3 = (r * r - J - 2 * V) % p
+    Y3 = (r * (V - X3) - 2 * Y1 * J) % p
+    Z3 = ((Z1 + H)**2 - Z1Z1 - HH) % p
+    return X3, Y3, Z3
+
+def _jac_to_affine(P, p):
+    """ convert a Jacobian point back to affine (x, y), or None for infinity """
+    X, Y, Z = P
+    if Z == 0:
+        return None
+    zinv = inv(Z, p)
+    zinv2 = zinv * zinv % p
+    return int(X * zinv2 % p), int(Y * zinv2 * zinv % p)
+
+def _jac_to_affine_many(Ps, p):
+    """
+    convert many (finite) Jacobian points to affine at once, with Montgomery's
+    trick: a single modular inverse plus 3 multiplications per point, instead
+    of one inverse per point
+    """
+    # prefix products of all the Z's
+    acc = [1]
+    for _, _, Z in Ps:
+        assert Z != 0
+        acc.append(acc[-1] * Z % p)
+    # invert the product once, then peel off one Z at a time walking backwards
+    t = inv(acc[-1], p)
+    out = [None] * len(Ps)
+    for i in reversed(range(len(Ps))):
+        X, Y, Z = Ps[i]
+        zinv = t * acc[i] % p
+        t = t * Z % p
+        zinv2 = zinv * zinv % p
+        out[i] = int(X * zinv2 % p), int(Y * zinv2 * zinv % p)
+    return out
+
+def _cswap(b, P, Q):
+    """
+    returns (Q, P) if the bit b is set, else (P, Q), for Jacobian points P, Q.
+    Done with masks on the coordinates rather than an if, so there is no
+    branch on b: mask is all ones if b is set, all zeros otherwise.
+    """
+    mask = -b
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    tX, tY, tZ = (X1 ^ X2) & mask, (Y1 ^ Y2) & mask, (Z1 ^ Z2) & mask
+    return (X1 ^ tX, Y1 ^ tY, Z1 ^ tZ), (X2 ^ tX, Y2 ^ tY, Z2 ^ tZ)
+
+def _jac_mul_ladder(k, P, a, p, nbits):
+    """
+    Montgomery ladder: returns k * P for the Jacobian point P, scanning the
+    low nbits bits of k. Every bit costs exactly one add and one double no
+    matter its value, and R1 - R0 = P is kept as an invariant throughout.
+    """
+    R0, R1 = _JAC_INF, P
+    for i in reversed(range(nbits)):
+        b = (k >> i) & 1
+        R0, R1 = _cswap(b, R0, R1)
+        R0, R1 = _jac_double(R0, a, p), _jac_add(R0, R1, a, p)
+        R0, R1 = _cswap(b, R0, R1)
+    return R0
+
+# -----------------------------------------------------------------------------
+# Window NAF scalar multiplication
+# Reference: Guide to Elliptic Curve Cryptography, Hankerson et al., Section 3.3
+
+def _wnaf(k, w=4):
+    """
+    Returns the width-w NAF of k, least significant digit first: every digit
+    is either 0 or odd with |d| < 2^(w-1), and any w consecutive digits
+    contain at most one non-zero, so on average only 1 in w+1 digits is.
+    """
+    digits = []
+    while k:
+        if k & 1:
+            d = k & (2**w - 1)
+            if d >= 2**(w - 1):
+                d -= 2**w
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+def _jac_mul_wnaf(terms, a, p, w=4):
+    """
+    Returns the sum of k * P over the (k, P) pairs in terms, with P in Jacobian
+    coordinates and k any (possibly negative) int. The wNAFs of all the
+    scalars are scanned jointly so they all share a single chain of
+    doublings, with one add per non-zero digit (Straus' trick).
+    """
+    precomps, nafs = [], []
+    for k, P in terms:
+        if k < 0:
+            k, P = -k, (P[0], p - P[1], P[2])
+        # precompute the odd multiples P, 3P, 5P, ..., (2^(w-1) - 1)P
+        P2 = _jac_double(P, a, p)
+        pre = [P]
+        for _ in range(2**(w - 2) - 1):
+            pre.append(_jac_add(pre[-1], P2, a, p))
+        precomps.append(pre)
+        nafs.append(_wnaf(k, w))
+    # pad all the nafs to the same length and pair them up with their tables
+    n = max(map(len, nafs))
+    terms = [(pre, naf + [0] * (n - len(naf))) for pre, naf in zip(precomps, nafs)]
+    # scan the digits from the most significant end
+    double, add = _jac_double, _jac_add # hoist the global lookups out of the loop
+    result = _JAC_INF
+    for i in reversed(range(n)):
+        result = double(result, a, p)
+        for pre, naf in terms:
+            d = naf[i]
+            if d > 0:
+                result = add(result, pre[d >> 1], a, p)
+            elif d < 0:
+                X, Y, Z = pre[-d >> 1]
+                result = add(result, (X, p - Y, Z), a, p) # negating a point is free
+    return result
 
 # -----------------------------------------------------------------------------
 # Core data structures to represent curves and generators
 
+@dataclass
+class Endomorphism:
+    """
+    An efficiently computable endomorphism phi(x, y) = (beta * x, y) = lam * (x, y)
+    on a curve with a = 0 (e.g. secp256k1), used for the GLV method: writing
+    k = k1 + k2 * lam (mod n) with k1, k2 only about half as long as k turns
+    k * P into k1 * P + k2 * phi(P), which needs half as many doublings.
+    """
+    beta: int   # a cube root of unity mod p
+    lam: int    # the matching cube root of unity mod n
+    n: int      # the order of the group
+    # a short basis (a1, b1), (a2, b2) of the lattice of (x, y) with x + y * lam = 0 (mod n)
+    a1: int
+    b1: int
+    a2: int
+    b2: int
+
+    def split(self, k: int):
+        """
+        Returns (k1, k2) s.t. k = k1 + k2 * lam (mod n), with |k1|, |k2| ~ sqrt(n)
+        Follows Algorithm 3.74 in Guide to Elliptic Curve Cryptography.
+        """
+        c1 = (self.b2 * k + self.n // 2) // self.n
+        c2 = (-self.b1 * k + self.n // 2) // self.n
+        k1 = k - c1 * self.a1 - c2 * self.a2
+        k2 = -c1 * self.b1 - c2 * self.b2
+        return k1, k2
+
 @dataclass
 class Curve:
     """
@@ -49,8 +306,9 @@ class Curve:
     p: int
     a: int
     b: int
+    endo: Endomorphism = field(default=None, repr=False, compare=False) # optional, for GLV
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Point:
     """ An integer point (x,y) on a Curve """
     curve: Curve
@@ -59,33 +317,78 @@ class Point:
 
     def __add__(self, other: Point) -> Point:
         # handle special case of P + 0 = 0 + P = 0
-        if self == INF:
+        if self.x is None:
             return other
-        if other == INF:
+        if other.x is None:
             return self
-        # handle special case of P + (-P) = 0
-        if self.x == other.x and self.y != other.y:
+        r = _add((self.x, self.y), (other.x, other.y), self.curve.a, self.curve.p)
+        return INF if r is None else Point(self.curve, *r)
+
+    def __rmul__(self, k: int) -> Point:
+        """
+        Returns k * self. This is variable time: both the wNAF/GLV path and the
+        short ladder below take time that depends on k (the ladder only scans
+        k.bit_length() bits). Use mul_ladder for secret scalars instead.
+        """
+        assert isinstance(k, int) and k >= 0
+        if self.x is None:
             return INF
-        # compute the "slope"
-        if self.x == other.x: # (self.y = other.y is guaranteed too per above check)
-            m = (3 * self.x**2 + self.curve.a) * inv(2 * self.y, self.curve.p)
+        # work in Jacobian coordinates so that the only modular inverse is
+        # the single one needed to convert back to affine at the end
+        a, p = self.curve.a, _field_int(self.curve.p)
+        if k.bit_length() > 32:
+            result = _jac_mul_wnaf(self._wnaf_terms(k), a, p)
         else:
-            m = (self.y - other.y) * inv(self.x - other.x, self.curve.p)
-        # compute the new point
-        rx = (m**2 - self.x - other.x) % self.curve.p
-        ry = (-(m*(rx - self.x) + self.y)) % self.curve.p
-        return Point(self.curve, rx, ry)
+            # not worth precomputing anything for a k this short
+            result = _jac_mul_ladder(k, (self.x, self.y, 1), a, p, k.bit_length())
+        r = _jac_to_affine(result, p)
+        return INF if r is None else Point(self.curve, *r)
 
-    def __rmul__(self, k: int) -> Point:
+    def mul_ladder(self, k: int) -> Point:
+        """
+        Returns k * self with the Montgomery ladder over a fixed number of
+        bits (the bit length of p, unless k is longer), so the sequence of
+        ladder steps does not depend on the bits of k. Slower than k * P, and
+        used by ecdsa.sign for its secret nonce.
+        This is as close to constant time as this pure Python code gets, but
+        not all the way: Python ints are variable time, and the Jacobian
+        formulas still shortcut while R0 is at infinity (k's leading zeros).
+        """
         assert isinstance(k, int) and k >= 0
-        result = INF
-        append = self
-        while k:
-            if k & 1:
-                result += append
-            append += append
-            k >>= 1
-        return result
+        if self.x is None:
+            return INF
+        a, p = self.curve.a, _field_int(self.curve.p)
+        nbits = max(k.bit_length(), p.bit_length())
+        result = _jac_mul_ladder(k, (self.x, self.y, 1), a, p, nbits)
+        r = _jac_to_affine(result, p)
+        return INF if r is None else Point(self.curve, *r)
+
+    def _wnaf_terms(self, k: int):
+        """ the (scalar, Jacobian point) terms that sum up to k * self for _jac_mul_wnaf """
+        P = (self.x, self.y, 1)
+        endo = self.curve.endo
+        if endo is None:
+            return [(k, P)]
+        # GLV: k * P = k1 * P + k2 * phi(P) with half length k1, k2
+        k1, k2 = endo.split(k % endo.n)
+        return [(k1, P), (k2, (endo.beta * self.x % self.curve.p, self.y, 1))]
+
+    @staticmethod
+    def double_scalar_mul(u1: int, P: Point, u2: int, Q: Point) -> Point:
+        """
+        Returns u1 * P + u2 * Q in one go (Shamir's trick): the wNAFs of both
+        scalars are scanned jointly, so the two multiplications share a
+        single chain of doublings instead of doing one each.
+        """
+        assert isinstance(u1, int) and u1 >= 0 and isinstance(u2, int) and u2 >= 0
+        if P.x is None or u1 == 0:
+            return u2 * Q
+        if Q.x is None or u2 == 0:
+            return u1 * P
+        a, p = P.curve.a, _field_int(P.curve.p)
+        result = _jac_mul_wnaf(P._wnaf_terms(u1) + Q._wnaf_terms(u2), a, p)
+        r = _jac_to_affine(result, p)
+        return INF if r is None else Point(P.curve, *r)
 
 @dataclass
 class Generator:
@@ -94,5 +397,56 @@ class Generator:
     """
     G: Point     # a generator point on the curve
     n: int       # the order of the generating point, so 0*G = n*G = INF
+    # fixed-base comb table of window width w, see precompute()
+    w: int = field(default=None, init=False, repr=False, compare=False)
+    table: list = field(default=None, init=False, repr=False, compare=False)
+
+    def precompute(self, w: int = 8):
+        """
+        Precompute the fixed-base comb table for G with window width w, where
+        table[i][j] = j * 2^(w*i) * G in affine (x, y), or None for j = 0.
+        Since G never changes this one-time cost is amortized over every k*G.
+        Each row is built with mixed additions and brought back to affine with
+        a single modular inverse, so even the 32 x 256 table for w = 8 is cheap.
+        """
+        a, p = self.G.curve.a, _field_int(self.G.curve.p)
+        table = []
+        base = (self.G.x, self.G.y) # affine 2^(w*i) * G for the current row i
+        for _ in range(-(-self.n.bit_length() // w)):
+            jac = []
+            acc = (*base, 1)
+            for _ in range(2**w):
+                jac.append(acc)
+                acc = _jac_add_affine(acc, base, a, p)
+            # jac is now [1, 2, ..., 2^w] * base, the last of which is the next base
+            row = _jac_to_affine_many(jac, p)
+            base = row.pop()
+            table.append([None] + row)
+        self.w = w
+        self.table = table
+
+    def mul_fixed(self, k: int) -> Point:
+        """
+        Returns k * G using the precomputed comb table: one table lookup and
+        one addition per w-bit window of k, and no doublings at all. The table
+        is built with the default width on first use if it is not there yet.
+        Every window does a fixed number of table lookups and one addition (a
+        dummy one for a zero window). This is NOT constant time though: the
+        addition itself still branches, e.g. while the accumulator is at infinity.
+        """
+        assert isinstance(k, int) and k >= 0
+        if self.table is None:
+            self.precompute()
+        a, p = self.G.curve.a, _field_int(self.G.curve.p)
+        k %= self.n
+        w, mask = self.w, 2**self.w - 1
+        result = _JAC_INF
+        for row in self.table:
+            d = k & mask
+            added = _jac_add_affine(result, row[d or 1], a, p)
+            result, _ = _cswap(d == 0, added, result)
+            k >>= w
+        r = _jac_to_affine(result, p)
+        return INF if r is None else Point(self.G.curve, *r)
 
-INF = Point(None, None, None)
+INF = Point(None, None, None) # the point at infinity, test for it with `.x is None`
@@ -6,13 +6,20 @@ Functions that sign/verify digital signatures and related utilities
 from dataclasses import dataclass
 from io import BytesIO
 
-from .sha256 import sha256
+from . import _secp256k1
+from .sha256 import hash256, sha256_many
 from cryptos.bitcoin import BITCOIN
 from cryptos.curves import inv, Point
-from cryptos.keys import gen_secret_key, PublicKey
+from cryptos.keys import gen_secret_key
+
 # -----------------------------------------------------------------------------
+# public API
+
+__all__ = ['Signature', 'sign', 'verify', 'verify_batch']
 
-@dataclass
+# -----------------------------------------------------------------------------
+
+@dataclass(frozen=True, slots=True)
 class Signature:
     r: int
     s: int
@@ -66,19 +73,29 @@ class Signature:
         frame = b''.join([bytes([0x30, len(content)]), content])
         return frame
 
-def sign(secret_key: int, message: bytes) -> Signature:
+def sign(secret_key: int, message: bytes, constant_time: bool = True) -> Signature:
+    """
+    Sign the message with the secret key. In pure Python the nonce point k*G
+    is computed with the Montgomery ladder by default, whose steps do not
+    depend on the bits of the secret nonce. constant_time=False uses the
+    (faster, but branchy) fixed-base comb instead.
+    """
 
     n = BITCOIN.gen.n
 
     # hash the message and convert to integer
     # TODO: do we want to do this here? or outside? probably not here
-    z = int.from_bytes(sha256(sha256(message)), 'big')
+    z = int.from_bytes(hash256(message), 'big')
+
+    # hand over to libsecp256k1 if we have it, it always produces low-s signatures too
+    if _secp256k1.AVAILABLE and 1 <= secret_key < n:
+        return Signature.decode(_secp256k1.sign(secret_key, z))
 
     # generate a new secret/public key pair at random
     # TODO: make deterministic
-    # TODO: make take constant time to mitigate timing attacks
     k = gen_secret_key(n)
-    P = PublicKey.from_sk(k)
+    # not PublicKey.from_sk, which would memoize the nonce
+    P = BITCOIN.gen.G.mul_ladder(k) if constant_time else BITCOIN.gen.mul_fixed(k)
 
     # calculate the signature
     r = P.x
@@ -91,21 +108,43 @@ def sign(secret_key: int, message: bytes) -> Signature:
 
 def verify(public_key: Point, message: bytes, sig: Signature) -> bool:
 
+    # hash the message and convert to integer
+    z = int.from_bytes(hash256(message), 'big')
+
+    return _verify(public_key, z, sig)
+
+def verify_batch(items) -> bool:
+    """
+    Verify many (public_key, message, sig) triples at once, returns True only if
+    all of the signatures are valid. All of the messages are hashed up front
+    in one batch before any of the elliptic curve math kicks in.
+    """
+    items = list(items)
+    hashes = sha256_many(sha256_many(message for _, message, _ in items))
+    for (public_key, _, sig), h in zip(items, hashes):
+        if not _verify(public_key, int.from_bytes(h, 'big'), sig):
+            return False
+    return True
+
+def _verify(public_key: Point, z: int, sig: Signature) -> bool:
+    """ verify sig against the already hashed message z """
+
     n = BITCOIN.gen.n
 
     # some super basic verification
     assert isinstance(sig.r, int) and 1 <= sig.r < n
     assert isinstance(sig.s, int) and 1 <= sig.s < n
 
-    # hash the message and convert to integer
-    z = int.from_bytes(sha256(sha256(message)), 'big')
+    # libsecp256k1 only accepts low-s signatures, but (r, s) is valid iff (r, n-s) is
+    if _secp256k1.AVAILABLE and public_key.x is not None:
+        der = Signature(sig.r, min(sig.s, n - sig.s)).encode()
+        return _secp256k1.verify(public_key.x, public_key.y, z, der)
 
     # verify signature
     w = inv(sig.s, n)
     u1 = z * w % n
     u2 = sig.r * w % n
-    P = (u1 * BITCOIN.gen.G) + (u2 * public_key)
+    P = Point.double_scalar_mul(u1, BITCOIN.gen.G, u2, public_key)
     match = P.x == sig.r
 
     return match
-
@@ -4,14 +4,21 @@ Utilities to generate secret/public key pairs and Bitcoin address
 easy consistent shortcuts of the two without collision)
 """
 
-import os
+import secrets
 import time
+from functools import lru_cache
 
+from . import _secp256k1
 from .curves import Point
 from .bitcoin import BITCOIN
-from .sha256 import sha256
+from .sha256 import sha256, hash256
 from .ripemd160 import ripemd160
 
+# -----------------------------------------------------------------------------
+# public API
+
+__all__ = ['gen_secret_key', 'PublicKey', 'gen_key_pair', 'gen_key_pairs', 'b58encode', 'b58decode', 'address_to_pkb_hash']
+
 # -----------------------------------------------------------------------------
 # Secret key generation. We're going to leave secret key as just a super plain int
 
@@ -20,20 +27,47 @@ def gen_secret_key(n: int) -> int:
     n is the upper bound on the key, typically the order of the elliptic curve
     we are using. The function will return a valid key, i.e. 1 <= key < n.
     """
-    while True:
-        key = int.from_bytes(os.urandom(32), 'big')
-        if 1 <= key < n:
-            break # the key is valid, break out
-    return key
+    # uniform over [1, n), rejection sampling is done for us by the stdlib
+    return secrets.randbelow(n - 1) + 1
 
 # -----------------------------------------------------------------------------
 # Public key - specific functions, esp encoding / decoding
 
+def _sqrt(a: int, p: int) -> int:
+    """
+    Returns a square root of a mod the secp256k1 prime p (if one exists). Since
+    p = 3 (mod 4) that is a^((p+1)/4), computed here with the same addition
+    chain as libsecp256k1: the exponent is mostly long runs of 1 bits, so we
+    build up a^(2^k - 1) for a few k and stitch them together with squarings,
+    which is 253 squarings and 13 multiplies, fewer than generic pow() does.
+    """
+    def sqn(v, n):
+        for _ in range(n):
+            v = v * v % p
+        return v
+    x2 = a * a % p * a % p # a^(2^2 - 1)
+    x3 = x2 * x2 % p * a % p
+    x6 = sqn(x3, 3) * x3 % p
+    x9 = sqn(x6, 3) * x3 % p
+    x11 = sqn(x9, 2) * x2 % p
+    x22 = sqn(x11, 11) * x11 % p
+    x44 = sqn(x22, 22) * x22 % p
+    x88 = sqn(x44, 44) * x44 % p
+    x176 = sqn(x88, 88) * x88 % p
+    x220 = sqn(x176, 44) * x44 % p
+    x223 = sqn(x220, 3) * x3 % p
+    # the exponent (p+1)/4 is 223 ones, a 0, 22 ones, 4 zeros, 2 ones, 2 zeros
+    t = sqn(x223, 23) * x22 % p
+    t = sqn(t, 6) * x2 % p
+    return sqn(t, 2)
+
 class PublicKey(Point):
     """
     The public key is just a Point on a Curve, but has some additional specific
     encoding / decoding functionality that this class implements.
     """
+    # memoized encodings, see encode() and address()
+    __slots__ = ('_enc_c', '_enc_u', '_h160_c', '_h160_u', '_addr')
 
     @classmethod
     def from_point(cls, pt: Point):
@@ -42,11 +76,16 @@ class PublicKey(Point):
 
     @classmethod
     def from_sk(cls, sk):
-        """ sk can be an int or a hex string """
+        """
+        sk can be an int or a hex string. The last 1024 derivations are memoized
+        (clear with _pk_from_sk.cache_clear()), so don't mutate the result.
+        Note that this means the secret keys themselves stay in memory too,
+        for as long as they are in the cache. Freshly generated keys (see
+        gen_key_pair) and signing nonces bypass it.
+        """
         assert isinstance(sk, (int, str))
         sk = int(sk, 16) if isinstance(sk, str) else sk
-        pk = sk * BITCOIN.gen.G
-        return cls.from_point(pk)
+        return _pk_from_sk(cls, sk)
 
     @classmethod
     def decode(cls, b: bytes):
@@ -57,7 +96,9 @@ class PublicKey(Point):
         if b[0] == 4:
             x = int.from_bytes(b[1:33], 'big')
             y = int.from_bytes(b[33:65], 'big')
-            return Point(BITCOIN.gen.G.curve, x, y)
+            pk = cls(BITCOIN.gen.G.curve, x, y)
+            object.__setattr__(pk, '_enc_u', b) # we already have the encoding, keep it
+            return pk
 
         # for compressed version uncompress the full public key Point
         # first recover the y-evenness and the full x
@@ -67,74 +108,132 @@ class PublicKey(Point):
 
         # solve y^2 = x^3 + 7 for y, but mod p
         p = BITCOIN.gen.G.curve.p
-        y2 = (pow(x, 3, p) + 7) % p
-        y = pow(y2, (p + 1) // 4, p)
-        y = y if ((y % 2 == 0) == is_even) else p - y # flip if needed to make the evenness agree
-        return cls(BITCOIN.gen.G.curve, x, y)
+        y2 = (x * x % p * x + 7) % p
+        y = _sqrt(y2, p)
+        y = y if (((y & 1) == 0) == is_even) else p - y # flip if needed to make the evenness agree
+        pk = cls(BITCOIN.gen.G.curve, x, y)
+        object.__setattr__(pk, '_enc_c', b)
+        return pk
+
+    @property
+    def sec_compressed(self) -> bytes:
+        """ the 33-byte compressed SEC encoding """
+        return self.encode(compressed=True)
 
     def encode(self, compressed, hash160=False):
-        """ return the SEC bytes encoding of the public key Point """
-        # calculate the bytes
-        if compressed:
-            prefix = b'\x02' if self.y % 2 == 0 else b'\x03'
-            pkb = prefix + self.x.to_bytes(32, 'big')
+        """
+        return the SEC bytes encoding of the public key Point. All four variants
+        are computed at most once per instance and then cached in a slot.
+        """
+        slot = ('_h160_' if hash160 else '_enc_') + ('c' if compressed else 'u')
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            pass
+        if hash160:
+            b = ripemd160(sha256(self.encode(compressed)))
+        elif compressed:
+            # prefix is 0x02 for even y and 0x03 for odd y, laid out in front of x
+            # as one big int, so that the whole thing is a single to_bytes call
+            b = ((0x02 | (self.y & 1)) << 256 | self.x).to_bytes(33, 'big')
         else:
-            pkb = b'\x04' + self.x.to_bytes(32, 'big') + self.y.to_bytes(32, 'big')
-        # hash if desired
-        return ripemd160(sha256(pkb)) if hash160 else pkb
+            b = (0x04 << 512 | self.x << 256 | self.y).to_bytes(65, 'big')
+        object.__setattr__(self, slot, b) # we're frozen, but this is just a cache
+        return b
 
     def address(self, net: str, compressed: bool) -> str:
         """ return the associated bitcoin address for this public key as string """
+        try:
+            return self._addr[net, compressed]
+        except AttributeError:
+            object.__setattr__(self, '_addr', {})
+        except KeyError:
+            pass
         # encode the public key into bytes and hash to get the payload
         pkb_hash = self.encode(compressed=compressed, hash160=True)
         # add version byte (0x00 for Main Network, or 0x6f for Test Network)
         version = {'main': b'\x00', 'test': b'\x6f'}
         ver_pkb_hash = version[net] + pkb_hash
         # calculate the checksum
-        checksum = sha256(sha256(ver_pkb_hash))[:4]
+        checksum = hash256(ver_pkb_hash)[:4]
         # append to form the full 25-byte binary Bitcoin Address
         byte_address = ver_pkb_hash + checksum
         # finally b58 encode the result
         b58check_address = b58encode(byte_address)
+        self._addr[net, compressed] = b58check_address
         return b58check_address
 
+def _derive_pk(cls, sk: int) -> PublicKey:
+    """ sk * G, uncached """
+    if _secp256k1.AVAILABLE and 1 <= sk < BITCOIN.gen.n:
+        x, y = _secp256k1.sk_to_pk(sk)
+        return cls(BITCOIN.gen.G.curve, x, y)
+    pk = BITCOIN.gen.mul_fixed(sk)
+    return cls.from_point(pk)
+
+_pk_from_sk = lru_cache(maxsize=1024)(_derive_pk)
+
 # -----------------------------------------------------------------------------
 # convenience functions
 
 def gen_key_pair():
     """ generate a (secret, public) key pair in one shot """
     sk = gen_secret_key(BITCOIN.gen.n)
-    pk = PublicKey.from_sk(sk)
+    pk = _derive_pk(PublicKey, sk) # a brand new key would never hit the cache, keep it out
     return sk, pk
 
+def _gen_key_pair(_):
+    return gen_key_pair()
+
+def gen_key_pairs(n: int, workers: int = None):
+    """
+    generate n (secret, public) key pairs, spread over a pool of worker
+    processes (default one per cpu). The curve math holds the GIL, so this
+    has to be processes rather than threads to actually use multiple cores.
+    """
+    from multiprocessing import Pool
+    with Pool(workers) as pool:
+        return pool.map(_gen_key_pair, range(n))
+
 # -----------------------------------------------------------------------------
 # base58 encoding / decoding utilities
 # reference: https://en.bitcoin.it/wiki/Base58Check_encoding
 
 alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 alphabet_inv = {c:i for i,c in enumerate(alphabet)}
+alphabet_bytes = alphabet.encode('ascii')
+# same as alphabet_inv but as a lookup table indexed by ascii code, 0xff for invalid chars
+alphabet_lut = bytes(alphabet_inv.get(chr(i), 0xff) for i in range(128))
 
 def b58encode(b: bytes) -> str:
     assert len(b) == 25 # version is 1 byte, pkb_hash 20 bytes, checksum 4 bytes
     n = int.from_bytes(b, 'big')
-    chars = []
+    # 25 bytes encode to at most 35 base58 chars, fill them in from the back
+    buf = bytearray(35)
+    i = 35
     while n:
-        n, i = divmod(n, 58)
-        chars.append(alphabet[i])
+        n, r = divmod(n, 58)
+        i -= 1
+        buf[i] = alphabet_bytes[r]
     # special case handle the leading 0 bytes... ¯\_(ツ)_/¯
     num_leading_zeros = len(b) - len(b.lstrip(b'\x00'))
-    res = num_leading_zeros * alphabet[0] + ''.join(reversed(chars))
+    res = (alphabet_bytes[:1] * num_leading_zeros + buf[i:]).decode('ascii')
     return res
 
 def b58decode(res: str) -> bytes:
-    n = sum(alphabet_inv[c] * 58**i for i, c in enumerate(reversed(res)))
+    # Horner's rule, most significant digit first, avoids computing any 58**i
+    n = 0
+    for c in res.encode('ascii'):
+        d = alphabet_lut[c]
+        assert d != 0xff, "invalid base58 character"
+        n = n * 58 + d
     return n.to_bytes(25, 'big') # version, pkb_hash, checksum bytes
 
 def address_to_pkb_hash(b58check_address: str) -> bytes:
     """ given an address in b58check recover the public key hash """
     byte_address = b58decode(b58check_address)
     # validate the checksum
-    assert byte_address[-4:] == sha256(sha256(byte_address[:-4]))[:4]
+    assert byte_address[-4:] == hash256(byte_address[:-4])[:4]
     # strip the version in front and the checksum at tail
     pkb_hash = byte_address[1:-4]
     return pkb_hash
@@ -4,13 +4,14 @@ Classes/utils for connecting to Bitcoin nodes
 Protocol Documentation: https://en.bitcoin.it/wiki/Protocol_documentation
 """
 
-from dataclasses import dataclass, field
-from typing import Dict, List, Tuple, Union
+from dataclasses import dataclass
+from typing import ClassVar, Dict, List, Tuple, Union
 
 import socket
+import struct
 from io import BytesIO
 
-from .sha256 import sha256
+from .sha256 import hash256
 from .transaction import encode_varint, decode_varint
 from .block import Block
 
@@ -21,7 +22,16 @@ MAGICS = {
     'test': b'\x0b\x11\x09\x07',
 }
 
-@dataclass
+# the 24-byte envelope header: magic, command (null padded), payload length, checksum
+_HDR = struct.Struct('<4s12sI4s')
+
+# an IPv4 address is sent as an IPv4-mapped IPv6 address, i.e. behind this prefix
+_IPV4_PREFIX = b'\x00' * 10 + b'\xff\xff'
+# services (little endian), 16-byte IPv6 address, port (big endian)
+_NETADDR_SERVICES = struct.Struct('<Q')
+_NETADDR_PORT = struct.Struct('>H')
+
+@dataclass(slots=True)
 class NetworkEnvelope:
     command: bytes
     payload: bytes
@@ -35,37 +45,28 @@ class NetworkEnvelope:
     def decode(cls, s, net):
         """ Construct a NetworkEnvelope from BytesIO stream s on a given net """
 
+        # read and unpack the whole header in one go
+        header = s.read(_HDR.size)
+        assert header != b'', "No magic bytes; Connection was reset?"
+        assert len(header) == _HDR.size, "Truncated envelope header"
+        magic, command, payload_length, checksum = _HDR.unpack(header)
         # validate magic bytes
-        magic = s.read(4)
-        assert magic != b'', "No magic bytes; Connection was reset?"
         assert magic == MAGICS[net]
-        # decode the command
-        command = s.read(12)
-        command = command.strip(b'\x00')
+        # decode the command, the padding is only ever at the end
+        command = command.rstrip(b'\x00')
         # decode and validate the payload
-        payload_length = int.from_bytes(s.read(4), 'little')
-        checksum = s.read(4)
         payload = s.read(payload_length)
-        assert checksum == sha256(sha256(payload))[:4]
+        assert checksum == hash256(payload)[:4]
 
         return cls(command, payload, net)
 
     def encode(self):
         """ Encode this network message as bytes """
-        out = []
-
-        out += [MAGICS[self.net]]
-        # encode the command
         assert len(self.command) <= 12
-        out += [self.command]
-        out += [b'\x00' * (12 - len(self.command))] # command padding
-        # encode the payload
-        assert len(self.payload) <= 2**32 # in practice reference client nodes will reject >= 32MB...
-        out += [len(self.payload).to_bytes(4, 'little')] # payload length
-        out += [sha256(sha256(self.payload))[:4]] # checksum
-        out += [self.payload]
-
-        return b''.join(out)
+        assert len(self.payload) < 2**32 # in practice reference client nodes will reject >= 32MB...
+        # struct pads the command with nulls up to 12 bytes for us
+        header = _HDR.pack(MAGICS[self.net], self.command, len(self.payload), hash256(self.payload)[:4])
+        return header + self.payload
 
     def stream(self):
         """ Stream the payload of this envelope """
@@ -75,7 +76,7 @@ class NetworkEnvelope:
 # Specific types of commands and their payload encoder/decords follow
 # -----------------------------------------------------------------------------
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class NetAddrStruct:
     """
     reference: https://en.bitcoin.it/wiki/Protocol_documentation#Network_address
@@ -86,18 +87,21 @@ class NetAddrStruct:
     port: int = 8333
 
     def encode(self):
-        out = []
-        # receiver services is 8 bytes little endian
-        out += [self.services.to_bytes(8, 'little')]
-        # IPV4 is 10 00 bytes and 2 ff bytes then receiver ip
         assert isinstance(self.ip, bytes) and len(self.ip) == 4
-        out += [b'\x00' * 10 + b'\xff\xff' + self.ip]
-        # receiver port is 2 bytes, big endian
-        out += [self.port.to_bytes(2, 'big')]
-        return b''.join(out)
+        return b''.join((
+            _NETADDR_SERVICES.pack(self.services),
+            _IPV4_PREFIX, self.ip,
+            _NETADDR_PORT.pack(self.port),
+        ))
 
+# the default (all zero) address, shared by every message that doesn't specify one
+_ZERO_NETADDR = NetAddrStruct()
+_ZERO_NETADDR_BYTES = _ZERO_NETADDR.encode()
 
-@dataclass
+def _encode_netaddr(addr: NetAddrStruct) -> bytes:
+    return _ZERO_NETADDR_BYTES if addr is _ZERO_NETADDR else addr.encode()
+
+@dataclass(slots=True)
 class VersionMessage:
     """
     reference: https://en.bitcoin.it/wiki/Protocol_documentation#version
@@ -111,9 +115,9 @@ class VersionMessage:
     services: int = 0 # info about what capabilities are available
     timestamp: int = None # 8 bytes Unix timestamp in little-endian
     # receiver net_addr
-    receiver: NetAddrStruct = field(default_factory=NetAddrStruct)
+    receiver: NetAddrStruct = _ZERO_NETADDR
     # sender net_addr
-    sender: NetAddrStruct = field(default_factory=NetAddrStruct)
+    sender: NetAddrStruct = _ZERO_NETADDR
     # additional metadata
     """
     uint64_t Node random nonce, randomly generated every time a version
@@ -123,7 +127,7 @@ class VersionMessage:
     user_agent: bytes = None # var_str: User Agent
     latest_block: int = 0 # "The last block received by the emitting node"
     relay: bool = False # Whether the remote peer should announce relayed transactions or not, see BIP 0037
-    command: str = field(init=False, default=b'version')
+    command: ClassVar[bytes] = b'version'
 
     @classmethod
     def decode(cls, s):
@@ -140,9 +144,9 @@ class VersionMessage:
         # timestamp is 8 bytes little endian
         out += [self.timestamp.to_bytes(8, 'little')]
         # receiver
-        out += [self.receiver.encode()]
+        out += [_encode_netaddr(self.receiver)]
         # sender
-        out += [self.sender.encode()]
+        out += [_encode_netaddr(self.sender)]
         # nonce should be 8 bytes
         assert isinstance(self.nonce, bytes) and len(self.nonce) == 8
         out += [self.nonce]
@@ -158,14 +162,14 @@ class VersionMessage:
 
         return b''.join(out)
 
-@dataclass
+@dataclass(slots=True)
 class VerAckMessage:
     """
     https://en.bitcoin.it/wiki/Protocol_documentation#verack
     The verack message is sent in reply to version. This message
     consists of only a message header with the command string "verack".
     """
-    command: str = field(init=False, default=b'verack')
+    command: ClassVar[bytes] = b'verack'
 
     @classmethod
     def decode(cls, s):
@@ -174,7 +178,7 @@ class VerAckMessage:
     def encode(self):
         return b''
 
-@dataclass
+@dataclass(slots=True)
 class PingMessage:
     """
     https://en.bitcoin.it/wiki/Protocol_documentation#ping
@@ -183,7 +187,7 @@ class PingMessage:
     to be a closed connection and the address is removed as a current peer.
     """
     nonce: bytes
-    command: str = field(init=False, default=b'ping')
+    command: ClassVar[bytes] = b'ping'
 
     @classmethod
     def decode(cls, s):
@@ -193,7 +197,7 @@ class PingMessage:
     def encode(self):
         return self.nonce
 
-@dataclass
+@dataclass(slots=True)
 class PongMessage:
     """
     https://en.bitcoin.it/wiki/Protocol_documentation#pong
@@ -202,7 +206,7 @@ class PongMessage:
     using a nonce included in the ping.
     """
     nonce: bytes
-    command: str = field(init=False, default=b'pong')
+    command: ClassVar[bytes] = b'pong'
 
     @classmethod
     def decode(cls, s):
@@ -212,7 +216,7 @@ class PongMessage:
     def encode(self):
         return self.nonce
 
-@dataclass
+@dataclass(slots=True)
 class GetHeadersMessage:
     """
     https://en.bitcoin.it/wiki/Protocol_documentation#getheaders
@@ -221,7 +225,7 @@ class GetHeadersMessage:
     num_hashes: int = 1 # var_int, number of block locator hash entries; can be >1 if there is a chain split
     start_block: bytes = None # char[32] block locator object
     end_block: bytes = None # char[32] hash of the last desired block header; set to zero to get as many blocks as possible
-    command: str = field(init=False, default=b'getheaders')
+    command: ClassVar[bytes] = b'getheaders'
 
     def __post_init__(self):
         assert isinstance(self.start_block, bytes) and len(self.start_block) == 32
@@ -236,30 +240,30 @@ class GetHeadersMessage:
         out += [self.end_block[::-1]] # little-endian
         return b''.join(out)
 
-@dataclass
+@dataclass(slots=True)
 class HeadersMessage:
     """
     https://en.bitcoin.it/wiki/Protocol_documentation#headers
     """
     blocks: List[Block] = None
-    command: str = field(init=False, default=b'headers')
+    command: ClassVar[bytes] = b'headers'
 
     @classmethod
     def decode(cls, s):
         count = decode_varint(s)
+        """
+        each header is 80 bytes followed by the number of transactions, which
+        is always zero if we only request the headers. This is done so that
+        the same code can be used to decode the "block" message, which contains
+        the full block information with all the transactions attached. Since
+        the layout is fixed we read everything at once and slice it up.
+        """
+        buf = memoryview(s.read(count * 81))
+        assert len(buf) == count * 81
         blocks = []
-        for _ in range(count):
-            b = Block.decode(s)
-            blocks.append(b)
-            """
-            the number of transactions is also given and is always zero if we
-            only request the headers. This is done so that the same code can be
-            used to decode the "block" message, which contains the full block
-            information with all the transactions attached. Here we just make
-            sure it is zero.
-            """
-            num_transactions = decode_varint(s)
-            assert num_transactions == 0
+        for i in range(0, len(buf), 81):
+            blocks.append(Block.from_bytes(buf[i:i+80]))
+            assert buf[i+80] == 0 # num_transactions
         return cls(blocks)
 
 # -----------------------------------------------------------------------------
@@ -275,7 +279,9 @@ class SimpleNode:
         port = {'main': 8333, 'test': 18333}[net]
         self.socket = socket.socket()
         self.socket.connect((host, port))
-        self.stream = self.socket.makefile('rb', None)
+        # the buffered reader fills its buffer with socket.recv_into under the hood,
+        # give it room for a good chunk of a headers message (2000 * 81 bytes) per syscall
+        self.stream = self.socket.makefile('rb', 65536)
 
     def send(self, message):
         env = NetworkEnvelope(message.command, message.encode(), net=self.net)
@@ -1,6 +1,7 @@
 """
 Implementing SHA-256 from scratch was fun, but for RIPEMD160 I am
 taking an existing implementation and made some cleanups and api changes.
+As with SHA-256, the rest of the library goes through hashlib when it can.
 """
 
 ## ripemd.py - pure Python implementation of the RIPEMD-160 algorithm.
@@ -44,11 +45,26 @@ taking an existing implementation and made some cleanups and api changes.
 
 import sys
 import struct
+import hashlib
 
 # -----------------------------------------------------------------------------
 # public interface
 
+# OpenSSL 3 moved ripemd160 into its "legacy" provider, which some builds don't
+# load, so only use hashlib if it actually supports it
+try:
+    hashlib.new('ripemd160')
+    HASHLIB_RIPEMD160 = True
+except ValueError:
+    HASHLIB_RIPEMD160 = False
+
 def ripemd160(b: bytes) -> bytes:
+    """ bytes to bytes, via the (much faster) hashlib version when available """
+    if HASHLIB_RIPEMD160:
+        return hashlib.new('ripemd160', b).digest()
+    return ripemd160_py(b)
+
+def ripemd160_py(b: bytes) -> bytes:
     """ simple wrapper for a simpler API to this hash function, just bytes to bytes """
     ctx = RMDContext()
     RMD160Update(ctx, b, len(b))
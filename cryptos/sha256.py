@@ -3,17 +3,26 @@ Follows the FIPS PUB 180-4 description for calculating SHA-256 hash function
 https://nvlpubs.nist.gov/nistpubs/FIPS/NIST.FIPS.180-4.pdf
 
 Noone in their right mind should use this for any serious reason. This was written
-purely for educational purposes.
+purely for educational purposes. The from-scratch version is kept as sha256_py,
+while sha256 (and the double hash256 used all over Bitcoin) go to hashlib, which
+is backed by OpenSSL and uses the SHA extensions of the CPU where available.
+Set the environment variable CRYPTOS_PURE_PY_SHA=1 to have sha256 / hash256, and
+the batch helpers sha256_many / sha256d_64 built on them, go through sha256_py
+instead, e.g. to watch the from-scratch version at work.
 """
 
+import os
 import math
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count, islice
 
 # -----------------------------------------------------------------------------
 # SHA-256 Functions, defined in Section 4
 
 def rotr(x, n, size=32):
-    return (x >> n) | (x << size - n) & (2**size - 1)
+    return (x >> n) | (x << size - n) & ((1 << size) - 1)
 
 def shr(x, n):
     return x >> n
@@ -36,12 +45,6 @@ def ch(x, y, z):
 def maj(x, y, z):
     return (x & y) ^ (x & z) ^ (y & z)
 
-def b2i(b):
-    return int.from_bytes(b, 'big')
-
-def i2b(i):
-    return i.to_bytes(4, 'big')
-
 # -----------------------------------------------------------------------------
 # SHA-256 Constants
 
@@ -87,6 +90,10 @@ def genH():
     """
     return [frac_bin(p ** (1/2.0)) for p in first_n_primes(8)]
 
+# the constants never change, so generate them only once at import
+K = tuple(genK())
+H0 = tuple(genH())
+
 # -----------------------------------------------------------------------------
 
 def pad(b):
@@ -109,10 +116,44 @@ def pad(b):
 
     return b
 
-def sha256(b: bytes) -> bytes:
+def compress(H, M):
+    """
+    Section 6.2.2: the SHA-256 compression function, mixes one 64-byte message
+    block M into the hash value H (8 32-bit ints) and returns the new one.
+    """
 
-    # Section 4.2
-    K = genK()
+    # 1. Prepare the message schedule, a 64-entry array of 32-bit words
+    # the first 16 words are just a copy of the block, read as big endian ints
+    W = list(struct.unpack('>16I', M))
+    for t in range(16, 64):
+        term1 = sig1(W[t-2])
+        term2 = W[t-7]
+        term3 = sig0(W[t-15])
+        term4 = W[t-16]
+        W.append((term1 + term2 + term3 + term4) & 0xFFFFFFFF)
+
+    # 2. Initialize the 8 working variables a,b,c,d,e,f,g,h with prev hash value
+    a, b, c, d, e, f, g, h = H
+
+    # 3. (note: x & 0xFFFFFFFF is just x % 2**32, but cheaper)
+    for t in range(64):
+        T1 = (h + capsig1(e) + ch(e, f, g) + K[t] + W[t]) & 0xFFFFFFFF
+        T2 = (capsig0(a) + maj(a, b, c)) & 0xFFFFFFFF
+        h = g
+        g = f
+        f = e
+        e = (d + T1) & 0xFFFFFFFF
+        d = c
+        c = b
+        b = a
+        a = (T1 + T2) & 0xFFFFFFFF
+
+    # 4. Compute the i-th intermediate hash value H^i
+    delta = [a, b, c, d, e, f, g, h]
+    H = [(i1 + i2) & 0xFFFFFFFF for i1, i2 in zip(H, delta)]
+    return H
+
+def sha256_py(b: bytes) -> bytes:
 
     # Section 5: Preprocessing
     # Section 5.1: Pad the message
@@ -121,49 +162,57 @@ def sha256(b: bytes) -> bytes:
     blocks = [b[i:i+64] for i in range(0, len(b), 64)]
 
     # for each message block M^1 ... M^N
-    H = genH() # Section 5.3
+    H = H0 # Section 5.3
 
     # Section 6
     for M in blocks: # each block is a 64-entry array of 8-bit bytes
+        H = compress(H, M)
+
+    return struct.pack('>8I', *H)
+
+# -----------------------------------------------------------------------------
+# fast versions used by the rest of the library
+
+PURE_PY_SHA = os.environ.get('CRYPTOS_PURE_PY_SHA', '0') == '1'
+
+if PURE_PY_SHA:
+
+    sha256 = sha256_py
+
+    def hash256(b: bytes) -> bytes:
+        """ double SHA-256, i.e. sha256(sha256(b)), used all over Bitcoin """
+        return sha256_py(sha256_py(b))
+
+else:
+
+    def sha256(b: bytes) -> bytes:
+        return hashlib.sha256(b).digest()
+
+    def hash256(b: bytes) -> bytes:
+        """ double SHA-256, i.e. sha256(sha256(b)), used all over Bitcoin """
+        return hashlib.sha256(hashlib.sha256(b).digest()).digest()
+
+def sha256_many(msgs: list) -> list:
+    """
+    SHA-256 of many independent messages at once. hashlib only releases the
+    GIL for inputs of at least 2KB, so only then is it worth fanning out over
+    a thread pool; small messages (signature hashes, Merkle nodes) are hashed
+    in a plain loop where threads would only add dispatch overhead. The same
+    goes for sha256_py (with CRYPTOS_PURE_PY_SHA=1), which never releases it.
+    """
+    msgs = list(msgs)
+    if PURE_PY_SHA or all(len(m) < 2048 for m in msgs):
+        return [sha256(m) for m in msgs]
+    with ThreadPoolExecutor() as ex:
+        return list(ex.map(sha256, msgs))
 
-        # 1. Prepare the message schedule, a 64-entry array of 32-bit words
-        W = []
-        for t in range(64):
-            if t <= 15:
-                # the first 16 words are just a copy of the block
-                W.append(bytes(M[t*4:t*4+4]))
-            else:
-                term1 = sig1(b2i(W[t-2]))
-                term2 = b2i(W[t-7])
-                term3 = sig0(b2i(W[t-15]))
-                term4 = b2i(W[t-16])
-                total = (term1 + term2 + term3 + term4) % 2**32
-                W.append(i2b(total))
-
-        # 2. Initialize the 8 working variables a,b,c,d,e,f,g,h with prev hash value
-        a, b, c, d, e, f, g, h = H
-
-        # 3.
-        for t in range(64):
-            T1 = (h + capsig1(e) + ch(e, f, g) + K[t] + b2i(W[t])) % 2**32
-            T2 = (capsig0(a) + maj(a, b, c)) % 2**32
-            h = g
-            g = f
-            f = e
-            e = (d + T1) % 2**32
-            d = c
-            c = b
-            b = a
-            a = (T1 + T2) % 2**32
-
-        # 4. Compute the i-th intermediate hash value H^i
-        delta = [a, b, c, d, e, f, g, h]
-        H = [(i1 + i2) % 2**32 for i1, i2 in zip(H, delta)]
-
-    return b''.join(i2b(i) for i in H)
+def sha256d_64(leaves: list) -> list:
+    """ hash256 of many 64-byte inputs, e.g. the concatenated pairs of a Merkle tree level """
+    assert all(len(leaf) == 64 for leaf in leaves)
+    return [hash256(leaf) for leaf in leaves]
 
 if __name__ == '__main__':
     import sys
     assert len(sys.argv) == 2, "Pass in exactly one filename to return checksum of"
     with open(sys.argv[1], 'rb') as f:
-        print(sha256(f.read()).hex())
+        print(sha256_py(f.read()).hex())
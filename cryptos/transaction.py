@@ -4,15 +4,21 @@ Reference: https://en.bitcoin.it/wiki/Transaction
 """
 
 from __future__ import annotations # PEP 563: Postponed Evaluation of Annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from typing import Dict, List, Tuple, Union
 
 import os
 import requests
 import string
+import struct
+import threading
+from collections import OrderedDict
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-from .sha256 import sha256
+from . import _secp256k1
+from .sha256 import sha256, hash256
 from .ripemd160 import ripemd160
 from .ecdsa import verify, Signature
 from .keys import PublicKey
@@ -26,20 +32,23 @@ def decode_int(s, nbytes, encoding='little'):
 def encode_int(i, nbytes, encoding='little'):
     return i.to_bytes(nbytes, encoding)
 
+# precompiled formats for the fixed size little endian fields of transactions
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_OUTPOINT = struct.Struct('<32sI') # prev_tx (little endian) and prev_index of a TxIn
+
+# all single byte values, so that small ints encode with a lookup instead of a call
+_B = [bytes((i,)) for i in range(256)]
+SIGHASH_ALL = encode_int(1, 4) # the sighash type appended to every message that gets signed
+
 def decode_varint(s):
     i = decode_int(s, 1)
-    if i == 0xfd:
-        return decode_int(s, 2)
-    elif i == 0xfe:
-        return decode_int(s, 4)
-    elif i == 0xff:
-        return decode_int(s, 8)
-    else:
-        return i
+    # 0xfd/0xfe/0xff markers are followed by 2/4/8 little endian bytes respectively
+    return i if i < 0xfd else int.from_bytes(s.read(1 << (i - 0xfc)), 'little')
 
 def encode_varint(i):
     if i < 0xfd:
-        return bytes([i])
+        return _B[i]
     elif i < 0x10000:
         return b'\xfd' + encode_int(i, 2)
     elif i < 0x100000000:
@@ -54,12 +63,85 @@ def encode_varint(i):
 class TxFetcher:
     """ lazily fetches transactions using an api on demand """
 
+    # (net, tx_id) -> raw bytes of the most recently used transactions, kept in
+    # memory on top of the disk cache below, least recently used ones get evicted
+    cache = OrderedDict()
+    cache_size = 1024
+    # the disk cache, one file per tx_id shared by all nets: a tx id is the hash
+    # of the tx bytes, so a file can only ever hold the one transaction it names
+    txdb_dir = 'txdb'
+    _lock = threading.Lock() # fetch_many hits the cache from many threads at once
+    # keep-alive sessions to reuse connections across api calls. One per thread,
+    # since a requests.Session is not documented to be thread safe
+    _local = threading.local()
+    # the worker threads of fetch_many, created on first use and kept around so
+    # that their sessions (and open connections) carry over from batch to batch
+    pool_size = 8
+    _pool = None
+
+    @staticmethod
+    def session() -> requests.Session:
+        """ the keep-alive session of the calling thread """
+        session = getattr(TxFetcher._local, 'session', None)
+        if session is None:
+            session = TxFetcher._local.session = requests.Session()
+        return session
+
+    @staticmethod
+    def pool() -> ThreadPoolExecutor:
+        """ the long-lived thread pool that fetch_many runs its api calls on """
+        with TxFetcher._lock:
+            if TxFetcher._pool is None:
+                TxFetcher._pool = ThreadPoolExecutor(TxFetcher.pool_size, thread_name_prefix='TxFetcher')
+            return TxFetcher._pool
+
+    @staticmethod
+    def cache_get(key):
+        """ the raw bytes cached in memory for key = (net, tx_id), or None """
+        with TxFetcher._lock:
+            raw = TxFetcher.cache.get(key)
+            if raw is not None:
+                TxFetcher.cache.move_to_end(key)
+            return raw
+
+    @staticmethod
+    def cache_put(key, raw: bytes):
+        with TxFetcher._lock:
+            TxFetcher.cache[key] = raw
+            TxFetcher.cache.move_to_end(key)
+            while len(TxFetcher.cache) > TxFetcher.cache_size:
+                TxFetcher.cache.popitem(last=False)
+
     @staticmethod
     def fetch(tx_id: str, net: str):
+        return Tx.decode(BytesIO(TxFetcher.fetch_raw(tx_id, net)))
+
+    @staticmethod
+    def fetch_raw(tx_id: str, net: str) -> bytes:
+        """ same as fetch, but returns the raw bytes of the transaction without decoding them """
         assert isinstance(tx_id, str)
-        assert all(c in string.hexdigits for c in tx_id)
+        assert not tx_id.strip(string.hexdigits) # only hex digits, checked in one C call
         tx_id = tx_id.lower() # normalize just in case we get caps
-        txdb_dir = 'txdb'
+        key = (net, tx_id)
+        raw = TxFetcher.cache_get(key)
+        if raw is None:
+            raw = TxFetcher._load(tx_id, net)
+            TxFetcher.cache_put(key, raw)
+        return raw
+
+    @staticmethod
+    def is_cached(tx_id: str, net: str) -> bool:
+        """
+        can tx_id be fetched without a trip to the api, i.e. is it in memory
+        for this net, or on disk (the disk cache is shared by all nets)
+        """
+        tx_id = tx_id.lower()
+        return (net, tx_id) in TxFetcher.cache or os.path.isfile(os.path.join(TxFetcher.txdb_dir, tx_id))
+
+    @staticmethod
+    def _load(tx_id: str, net: str) -> bytes:
+        """ the raw bytes of a tx from the disk cache, or else from the api """
+        txdb_dir = TxFetcher.txdb_dir
         cache_file = os.path.join(txdb_dir, tx_id)
 
         # cache transactions on disk so we're not stressing the generous API provider
@@ -78,21 +160,36 @@ class TxFetcher:
                 url = 'https://blockstream.info/testnet/api/tx/%s/hex' % (tx_id, )
             else:
                 raise ValueError("%s is not a valid net type, should be main|test" % (net, ))
-            response = requests.get(url)
+            response = TxFetcher.session().get(url)
             assert response.status_code == 200, "transaction id %s was not found on blockstream" % (tx_id, )
             raw = bytes.fromhex(response.text.strip())
+            # ensure that the calculated id matches the request id, once, before we cache it
+            assert Tx.decode(BytesIO(raw)).id() == tx_id
             # cache on disk
             if not os.path.isdir(txdb_dir):
                 os.makedirs(txdb_dir, exist_ok=True)
             with open(cache_file, 'wb') as f:
                 f.write(raw)
+        return raw
 
-        tx = Tx.decode(BytesIO(raw))
-        assert tx.id() == tx_id # ensure that the calculated id matches the request id
-        return tx
+    @staticmethod
+    def fetch_many(tx_ids, net: str):
+        """
+        warm the cache with many transactions at once: the api round trips for
+        the ones that are not cached yet are made concurrently instead of one
+        after another, on the threads of pool(). Nothing is decoded, later
+        fetch() calls do that.
+        """
+        missing = [tx_id for tx_id in set(tx_ids) if not TxFetcher.is_cached(tx_id, net)]
+        if len(missing) <= 1:
+            # nothing to overlap, don't bother spinning up a pool
+            for tx_id in missing:
+                TxFetcher.fetch_raw(tx_id, net)
+            return
+        list(TxFetcher.pool().map(lambda tx_id: TxFetcher.fetch_raw(tx_id, net), missing))
 
 
-@dataclass
+@dataclass(slots=True)
 class Tx:
     version: int
     tx_ins: List[TxIn]
@@ -104,7 +201,7 @@ class Tx:
     def decode(cls, s):
         """ s is a stream of bytes, e.g. BytesIO(b'...') """
         # decode version
-        version = decode_int(s, 4)
+        version, = _U32.unpack(s.read(4))
         # decode inputs + detect segwit transactions
         segwit = False
         num_inputs = decode_varint(s)
@@ -133,7 +230,7 @@ class Tx:
                         items.append(s.read(item_len))
                 tx_in.witness = items
         # decode locktime
-        locktime = decode_int(s, 4)
+        locktime, = _U32.unpack(s.read(4))
         return cls(version, inputs, outputs, locktime, segwit)
 
     def encode(self, force_legacy=False, sig_index=-1) -> bytes:
@@ -144,39 +241,74 @@ class Tx:
         This result then constitutes the "message" that gets signed
         by the aspiring transactor of this input.
         """
-        out = []
+        out = bytearray()
         # encode metadata
-        out += [encode_int(self.version, 4)]
+        out += encode_int(self.version, 4)
         if self.segwit and not force_legacy:
-            out += [b'\x00\x01'] # segwit marker + flag bytes
+            out += b'\x00\x01' # segwit marker + flag bytes
         # encode inputs
-        out += [encode_varint(len(self.tx_ins))]
-        if sig_index == -1:
-            out += [tx_in.encode() for tx_in in self.tx_ins]
-        else:
-            out += [tx_in.encode(script_override=(sig_index == i))
-                    for i, tx_in in enumerate(self.tx_ins)]
+        out += encode_varint(len(self.tx_ins))
+        for i, tx_in in enumerate(self.tx_ins):
+            tx_in.encode(script_override=None if sig_index == -1 else (sig_index == i), out=out)
         # encode outputs
-        out += [encode_varint(len(self.tx_outs))]
-        out += [tx_out.encode() for tx_out in self.tx_outs]
+        out += encode_varint(len(self.tx_outs))
+        for tx_out in self.tx_outs:
+            tx_out.encode(out=out)
         # encode witnesses
         if self.segwit and not force_legacy:
             for tx_in in self.tx_ins:
-                out += [encode_varint(len(tx_in.witness))] # num_items
+                out += encode_varint(len(tx_in.witness)) # num_items
                 for item in tx_in.witness:
                     if isinstance(item, int):
-                        out += [encode_varint(item)]
+                        out += encode_varint(item)
                     else: # bytes
-                        out += [encode_varint(len(item)), item]
+                        out += encode_varint(len(item))
+                        out += item
         # encode... other metadata I guess
-        out += [encode_int(self.locktime, 4)]
-        out += [encode_int(1, 4) if sig_index != -1 else b''] # 1 = SIGHASH_ALL
-        return b''.join(out)
+        out += encode_int(self.locktime, 4)
+        if sig_index != -1:
+            out += SIGHASH_ALL
+        return bytes(out)
+
+    def sig_messages(self) -> List[bytes]:
+        """
+        returns the list of encode(sig_index=i) for all inputs i, i.e. the messages
+        signed for each of the inputs. They only differ in which one input carries
+        its script_pubkey (all others have an empty script), so everything else
+        is encoded just once and shared, instead of re-encoding the whole
+        transaction once per input.
+        """
+        assert not self.segwit # todo for segwits
+        blanks = [tx_in.encode(script_override=False) for tx_in in self.tx_ins]
+        head = encode_int(self.version, 4) + encode_varint(len(self.tx_ins))
+        tail = b''.join([encode_varint(len(self.tx_outs))] +
+                        [tx_out.encode() for tx_out in self.tx_outs] +
+                        [encode_int(self.locktime, 4), SIGHASH_ALL])
+        return [b''.join([head, *blanks[:i], tx_in.encode(script_override=True), *blanks[i+1:], tail])
+                for i, tx_in in enumerate(self.tx_ins)]
+
+    def clone_with(self, index: int, script_sig: Script) -> Tx:
+        """
+        returns a shallow copy of this transaction with the script_sig of input
+        index swapped out, this transaction itself is left untouched
+        """
+        tx_ins = list(self.tx_ins)
+        tx_ins[index] = replace(tx_ins[index], script_sig=script_sig)
+        return replace(self, tx_ins=tx_ins)
 
     def id(self) -> str:
-        return sha256(sha256(self.encode(force_legacy=True)))[::-1].hex()
+        return hash256(self.encode(force_legacy=True))[::-1].hex()
+
+    def prefetch(self):
+        """
+        fetch the previous transactions of all inputs concurrently, so that the
+        lookups in value() / script_pubkey() that follow are all cache hits
+        """
+        for net in set(tx_in.net for tx_in in self.tx_ins):
+            TxFetcher.fetch_many(set(tx_in.prev_tx.hex() for tx_in in self.tx_ins if tx_in.net == net), net)
 
     def fee(self) -> int:
+        self.prefetch()
         input_total = sum(tx_in.value() for tx_in in self.tx_ins)
         output_total = sum(tx_out.amount for tx_out in self.tx_outs)
         return input_total - output_total
@@ -185,24 +317,26 @@ class Tx:
         assert not self.segwit # todo for segwits
 
         # validate that this transaction is not minting coins
+        # (note: this also prefetches all the previous transactions for below)
         if self.fee() < 0:
             return False
 
         # validate the digital signatures of all inputs
-        for i, tx in enumerate(self.tx_ins):
-            """
-            note: here we should be decoding the sighash-type, which is the
-            last byte appended on top of the DER signature in the script_sig,
-            and encoding the signing bytes accordingly. For now we assume the
-            most common type of signature, which is 1 = SIGHASH_ALL
-            """
-            mod_tx_enc = self.encode(sig_index=i)
-            combined = tx.script_sig + tx.script_pubkey() # Script addition
-            valid = combined.evaluate(mod_tx_enc)
-            if not valid:
-                return False
-
-        return True
+        """
+        note: here we should be decoding the sighash-type, which is the
+        last byte appended on top of the DER signature in the script_sig,
+        and encoding the signing bytes accordingly. For now we assume the
+        most common type of signature, which is 1 = SIGHASH_ALL
+        """
+        combined = [tx.script_sig + tx.script_pubkey() for tx in self.tx_ins] # Script addition
+        evaluate = lambda args: args[0].evaluate(args[1])
+        jobs = zip(combined, self.sig_messages())
+        if _secp256k1.AVAILABLE and len(combined) > 1:
+            # libsecp256k1 releases the GIL while verifying, so the inputs can go in parallel
+            with ThreadPoolExecutor() as ex:
+                return all(ex.map(evaluate, jobs))
+        # the pure Python curve math holds the GIL, threads would only add overhead
+        return all(map(evaluate, jobs))
 
     def is_coinbase(self) -> bool:
         return (len(self.tx_ins) == 1) and \
@@ -214,7 +348,7 @@ class Tx:
         return int.from_bytes(self.tx_ins[0].script_sig.cmds[0], 'little') if self.is_coinbase() else None
 
 
-@dataclass
+@dataclass(slots=True)
 class TxIn:
     prev_tx: bytes # prev transaction ID: hash256 of prev tx contents
     prev_index: int # UTXO output index in the transaction
@@ -225,32 +359,34 @@ class TxIn:
 
     @classmethod
     def decode(cls, s):
-        prev_tx = s.read(32)[::-1] # 32 bytes little endian
-        prev_index = decode_int(s, 4)
+        prev_tx, prev_index = _OUTPOINT.unpack(s.read(36))
+        prev_tx = prev_tx[::-1] # 32 bytes little endian
         script_sig = Script.decode(s)
-        sequence = decode_int(s, 4)
+        sequence, = _U32.unpack(s.read(4))
         return cls(prev_tx, prev_index, script_sig, sequence)
 
-    def encode(self, script_override=None):
-        out = []
-        out += [self.prev_tx[::-1]]
-        out += [encode_int(self.prev_index, 4)]
+    def encode(self, script_override=None, out=None):
+        """ encode this input, appending to the bytearray out if one is given """
+        ret = out is None
+        out = bytearray() if ret else out
+        out += self.prev_tx[::-1]
+        out += encode_int(self.prev_index, 4)
 
         if script_override is None:
             # None = just use the actual script
-            out += [self.script_sig.encode()]
+            self.script_sig.encode(out)
         elif script_override is True:
             # True = override the script with the script_pubkey of the associated input
             tx = TxFetcher.fetch(self.prev_tx.hex(), net=self.net)
-            out += [tx.tx_outs[self.prev_index].script_pubkey.encode()]
+            tx.tx_outs[self.prev_index].script_pubkey.encode(out)
         elif script_override is False:
             # False = override with an empty script
-            out += [Script([]).encode()]
+            Script([]).encode(out)
         else:
             raise ValueError("script_override must be one of None|True|False")
 
-        out += [encode_int(self.sequence, 4)]
-        return b''.join(out)
+        out += encode_int(self.sequence, 4)
+        return bytes(out) if ret else None
 
     def value(self):
         # look the amount up on the previous transaction
@@ -265,25 +401,27 @@ class TxIn:
         return script
 
 
-@dataclass
+@dataclass(slots=True)
 class TxOut:
     amount: int # in units of satoshi (1e-8 of a bitcoin)
     script_pubkey: Script # locking script
 
     @classmethod
     def decode(cls, s):
-        amount = decode_int(s, 8)
+        amount, = _U64.unpack(s.read(8))
         script_pubkey = Script.decode(s)
         return cls(amount, script_pubkey)
 
-    def encode(self):
-        out = []
-        out += [encode_int(self.amount, 8)]
-        out += [self.script_pubkey.encode()]
-        return b''.join(out)
+    def encode(self, out=None):
+        """ encode this output, appending to the bytearray out if one is given """
+        ret = out is None
+        out = bytearray() if ret else out
+        out += encode_int(self.amount, 8)
+        self.script_pubkey.encode(out)
+        return bytes(out) if ret else None
 
 
-@dataclass
+@dataclass(slots=True)
 class Script:
     cmds: List[Union[int, bytes]]
 
@@ -296,78 +434,85 @@ class Script:
     @classmethod
     def decode(cls, s):
         length = decode_varint(s)
+        # read the whole script in one go, then walk over it with an offset
+        b = s.read(length)
         cmds = []
         count = 0 # number of bytes read
         while count < length:
-            current = s.read(1)[0] # read current byte as integer
+            current = b[count] # read current byte as integer
             count += 1
             # push commands onto stack, elements as bytes or ops as integers
             if 1 <= current <= 75:
                 # elements of size [1, 75] bytes
-                cmds.append(s.read(current))
-                count += current
+                data_length = current
             elif current == 76:
                 # op_pushdata1: elements of size [76, 255] bytes
-                data_length = decode_int(s, 1)
-                cmds.append(s.read(data_length))
-                count += data_length + 1
+                data_length = b[count]
+                count += 1
             elif current == 77:
                 # op_pushdata2: elements of size [256-520] bytes
-                data_length = decode_int(s, 2)
-                cmds.append(s.read(data_length))
-                count += data_length + 2
+                data_length = int.from_bytes(b[count:count+2], 'little')
+                count += 2
             else:
                 # represents an op_code, add it (as int)
                 cmds.append(current)
+                continue
+            cmds.append(b[count:count+data_length])
+            count += data_length
         if count != length:
             raise SyntaxError('parsing script failed')
         return cls(cmds)
 
-    def encode(self):
-        out = []
+    def encode(self, out=None):
+        """ encode this script, appending to the bytearray out if one is given """
+        body = bytearray()
         for cmd in self.cmds:
             if isinstance(cmd, int):
                 # an int is just an opcode, encode as a single byte
-                out += [encode_int(cmd, 1)]
+                body += _B[cmd]
             else:
                 # bytes represent an element, encode its length and then content
                 length = len(cmd) # in bytes
-                if length < 75:
-                    out += [encode_int(length, 1)]
+                if length <= 75:
+                    body += _B[length]
                 elif 76 <= length <= 255:
-                    out += [encode_int(76, 1), encode_int(length, 1)] # pushdata1
+                    body += _B[76] # pushdata1
+                    body += _B[length]
                 elif 256 <= length <= 520:
-                    out += [encode_int(77, 1), encode_int(length, 2)] # pushdata2
+                    body += _B[77] # pushdata2
+                    body += encode_int(length, 2)
                 else:
                     raise ValueError("cmd of length %d bytes is too long?" % (length, ))
-                out += [cmd]
-        ret = b''.join(out)
-        return encode_varint(len(ret)) + ret
+                body += cmd
+        if out is None:
+            return encode_varint(len(body)) + bytes(body)
+        out += encode_varint(len(body))
+        out += body
 
     def evaluate(self, mod_tx_enc):
 
         # for now let's just support a standard p2pkh transaction
-        assert len(self.cmds) == 7
-        assert isinstance(self.cmds[0], bytes) # signature
-        assert isinstance(self.cmds[1], bytes) # pubkey
-        assert isinstance(self.cmds[2], int) and (OP_CODE_NAMES[self.cmds[2]] == 'OP_DUP')
-        assert isinstance(self.cmds[3], int) and (OP_CODE_NAMES[self.cmds[3]] == 'OP_HASH160')
-        assert isinstance(self.cmds[4], bytes) # hash
-        assert isinstance(self.cmds[5], int) and (OP_CODE_NAMES[self.cmds[5]] == 'OP_EQUALVERIFY')
-        assert isinstance(self.cmds[6], int) and (OP_CODE_NAMES[self.cmds[6]] == 'OP_CHECKSIG')
+        cmds = self.cmds
+        assert len(cmds) == 7
+        assert isinstance(cmds[0], bytes) # signature
+        assert isinstance(cmds[1], bytes) # pubkey
+        assert isinstance(cmds[4], bytes) # hash
+        assert (cmds[2], cmds[3], cmds[5], cmds[6]) == _P2PKH_OPS
 
         # verify the public key hash, answering the OP_EQUALVERIFY challenge
-        pubkey, pubkey_hash = self.cmds[1], self.cmds[4]
-        if pubkey_hash != ripemd160(sha256(pubkey)):
+        # (on the raw bytes, so that a bogus key is rejected before we try to decode it)
+        sec, pubkey_hash = cmds[1], cmds[4] # SEC encoded public key
+        if pubkey_hash != ripemd160(sha256(sec)):
             return False
+        if not (len(sec) == 33 and sec[0] in (2, 3) or len(sec) == 65 and sec[0] == 4):
+            return False # the hash matches, but these bytes are not a SEC public key at all
+        pk = _decode_pubkey(sec)
 
         # verify the digital signature of the transaction, answering the OP_CHECKSIG challenge
-        sighash_type = self.cmds[0][-1] # the last byte is the sighash type
+        sighash_type = cmds[0][-1] # the last byte is the sighash type
         assert sighash_type == 1 # 1 is SIGHASH_ALL, most commonly used and only one supported right now
-        der = self.cmds[0][:-1] # DER encoded signature, but crop out the last byte
-        sec = self.cmds[1] # SEC encoded public key
+        der = cmds[0][:-1] # DER encoded signature, but crop out the last byte
         sig = Signature.decode(der)
-        pk = PublicKey.decode(sec)
         valid = verify(pk, mod_tx_enc, sig)
 
         return valid
@@ -375,6 +520,14 @@ class Script:
     def __add__(self, other):
         return Script(self.cmds + other.cmds)
 
+@lru_cache(maxsize=4096)
+def _decode_pubkey(sec: bytes) -> PublicKey:
+    """
+    the same public key tends to show up in many inputs (e.g. a wallet spending
+    several of its own outputs), so keep the decoded keys around. Only called
+    for keys that passed the OP_EQUALVERIFY check, i.e. well formed ones.
+    """
+    return PublicKey.decode(sec)
 
 OP_CODE_NAMES = {
     0: 'OP_0',
@@ -469,3 +622,7 @@ OP_CODE_NAMES = {
     184: 'OP_NOP9',
     185: 'OP_NOP10',
 }
+
+# the opcodes of a combined p2pkh script, i.e. OP_DUP OP_HASH160 OP_EQUALVERIFY OP_CHECKSIG
+_P2PKH_OPS = (118, 169, 136, 172)
+assert tuple(OP_CODE_NAMES[op] for op in _P2PKH_OPS) == ('OP_DUP', 'OP_HASH160', 'OP_EQUALVERIFY', 'OP_CHECKSIG')
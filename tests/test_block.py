@@ -5,7 +5,7 @@ Test Block
 from io import BytesIO
 
 from cryptos.block import Block, calculate_new_bits, bits_to_target, target_to_bits
-from cryptos.block import GENESIS_BLOCK
+from cryptos.block import GENESIS_BLOCK, merkle_root
 
 def test_block():
 
@@ -70,3 +70,20 @@ def test_genesis_block():
     assert block.id()                     == '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
     assert format(block.target(), '064x') == '00000000ffff0000000000000000000000000000000000000000000000000000'
     assert block.validate()
+
+def test_merkle_root():
+
+    # the 4 transactions of block 100000
+    tx_ids = [
+        '8c14f0db3df150123e6f3dbbf30f8b955a8249b62ac1d1ff16284aefa3d06d87',
+        'fff2525b8931402dd09222c50775608f75787bd2b87e56995a7bdd30f79702c4',
+        '6359f0868171b1d194cbee1af2f16ea598ae8fad666d9b012c8ed2b79a236ec4',
+        'e9a66845e05d5abc0ad04ec80f774a7e585c6e8db975962d069a522137b80c1d',
+    ]
+    hashes = [bytes.fromhex(tx_id)[::-1] for tx_id in tx_ids]
+    root = merkle_root(hashes)[::-1].hex()
+    assert root == 'f3e94742aca4b5ef85488dc37c06c3282295ffec960994b2c0d5ac2a25a95766'
+
+    # a single transaction is its own root, an odd count duplicates the last one
+    assert merkle_root(hashes[:1]) == hashes[0]
+    assert merkle_root(hashes[:3]) == merkle_root(hashes[:3] + hashes[2:3])
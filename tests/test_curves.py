@@ -0,0 +1,67 @@
+"""
+Test the elliptic curve math, esp. that all the faster scalar multiplication
+paths agree with plain affine double-and-add
+"""
+
+import os
+import copy
+import pickle
+
+from cryptos.bitcoin import BITCOIN
+from cryptos.curves import Point, INF, _add, _wnaf
+
+def slow_mul(k, P):
+    """ reference affine double-and-add """
+    result, append = None, (P.x, P.y)
+    while k:
+        if k & 1:
+            result = _add(result, append, P.curve.a, P.curve.p)
+        append = _add(append, append, P.curve.a, P.curve.p)
+        k >>= 1
+    return INF if result is None else Point(P.curve, *result)
+
+def test_wnaf():
+
+    for k in [1, 2, 7, 0xdeadbeef, 2**256 - 1] + [int.from_bytes(os.urandom(32), 'big') for _ in range(10)]:
+        digits = _wnaf(k, 4)
+        assert sum(d * 2**i for i, d in enumerate(digits)) == k
+        assert all(d == 0 or (d % 2 == 1 and abs(d) < 8) for d in digits)
+
+def test_scalar_mul():
+
+    G, n = BITCOIN.gen.G, BITCOIN.gen.n
+    P = 0xdeadbeef * G
+    ks = [0, 1, 2, 3, 5000, 2**32, n - 1, n, n + 1] + [int.from_bytes(os.urandom(32), 'big') for _ in range(10)]
+    for k in ks:
+        for Q in [G, P]:
+            assert k * Q == slow_mul(k, Q)
+            assert Q.mul_ladder(k) == slow_mul(k, Q)
+        assert BITCOIN.gen.mul_fixed(k) == slow_mul(k, G)
+
+def test_double_scalar_mul():
+
+    G, n = BITCOIN.gen.G, BITCOIN.gen.n
+    P = 0xdeadbeef * G
+    for _ in range(5):
+        u1, u2 = [int.from_bytes(os.urandom(32), 'big') % n for _ in range(2)]
+        assert Point.double_scalar_mul(u1, G, u2, P) == slow_mul(u1, G) + slow_mul(u2, P)
+    assert Point.double_scalar_mul(0, G, 5, P) == 5 * P
+    assert Point.double_scalar_mul(3, G, n - 3, G) == INF
+
+def test_inf_copies():
+
+    G = BITCOIN.gen.G
+    for O in [pickle.loads(pickle.dumps(INF)), copy.copy(INF), Point(None, None, None)]:
+        assert O is not INF and O == INF
+        assert O + G == G and G + O == G
+        assert 5 * O == INF and O.mul_ladder(5) == INF
+        assert Point.double_scalar_mul(3, O, 2, G) == 2 * G
+
+def test_glv_split():
+
+    endo = BITCOIN.gen.G.curve.endo
+    n = BITCOIN.gen.n
+    for k in [1, n - 1] + [int.from_bytes(os.urandom(32), 'big') % n for _ in range(10)]:
+        k1, k2 = endo.split(k)
+        assert (k1 + k2 * endo.lam) % n == k
+        assert abs(k1).bit_length() <= 129 and abs(k2).bit_length() <= 129
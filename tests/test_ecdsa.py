@@ -5,9 +5,12 @@ Test our ability to sign and verify digital signatures
 import os
 from io import BytesIO
 
+import pytest
+
+from cryptos import _secp256k1, ecdsa
 from cryptos.bitcoin import BITCOIN
-from cryptos.keys import gen_key_pair
-from cryptos.ecdsa import Signature, sign, verify
+from cryptos.keys import gen_key_pair, gen_secret_key, PublicKey
+from cryptos.ecdsa import Signature, sign, verify, verify_batch
 from cryptos.transaction import Tx
 
 def test_ecdsa():
@@ -40,6 +43,62 @@ def test_ecdsa():
 
     # the end.
 
+def test_verify_batch():
+
+    sk1, pk1 = gen_key_pair()
+    sk2, pk2 = gen_key_pair()
+    messages = [('message number %d' % i).encode('ascii') for i in range(4)]
+
+    items = [(pk1, m, sign(sk1, m)) for m in messages[:2]] + [(pk2, m, sign(sk2, m)) for m in messages[2:]]
+    assert verify_batch(items)
+
+    # a single signature under the wrong key spoils the whole batch
+    items[-1] = (pk1, messages[-1], items[-1][2])
+    assert not verify_batch(items)
+
+def test_sign_constant_time(monkeypatch):
+    # the ladder and the comb must produce the very same signature for the same nonce
+    monkeypatch.setattr(_secp256k1, 'AVAILABLE', False)
+    n = BITCOIN.gen.n
+    sk, pk = gen_key_pair()
+    message = b'same nonce, same signature'
+    for k in [1, 2, n - 1, gen_secret_key(n)]:
+        monkeypatch.setattr(ecdsa, 'gen_secret_key', lambda n: k)
+        sig = sign(sk, message)
+        assert sig == sign(sk, message, constant_time=False)
+        assert verify(pk, message, sig)
+
+def test_secp256k1_backend(monkeypatch):
+    # cross-check the optional libsecp256k1 backend against the pure Python code
+    pytest.importorskip('coincurve')
+    assert _secp256k1.AVAILABLE
+    n = BITCOIN.gen.n
+    message = b'cross-checking the two backends'
+
+    for _ in range(4):
+        sk = gen_secret_key(n)
+
+        # public key derivation
+        pk = PublicKey.from_sk(sk) # goes through coincurve
+        G = BITCOIN.gen.mul_fixed(sk) # pure Python
+        assert (pk.x, pk.y) == (G.x, G.y)
+
+        # signatures made by libsecp256k1 are always low-s, check them in pure Python
+        sig_c = sign(sk, message)
+        assert sig_c.s <= n // 2
+        monkeypatch.setattr(_secp256k1, 'AVAILABLE', False)
+        assert verify(pk, message, sig_c)
+        assert not verify(pk, message + b'!', sig_c)
+
+        # and the other way around, including the high-s twin of the signature,
+        # which libsecp256k1 would reject on its own but is just as valid
+        sig_p = sign(sk, message)
+        sig_p_high = Signature(sig_p.r, n - sig_p.s)
+        assert verify(pk, message, sig_p) and verify(pk, message, sig_p_high)
+        monkeypatch.setattr(_secp256k1, 'AVAILABLE', True)
+        assert verify(pk, message, sig_p) and verify(pk, message, sig_p_high)
+        assert not verify(pk, message + b'!', sig_p_high)
+
 def test_sig_der():
 
     # a transaction used as an example in programming bitcoin
@@ -1,6 +1,9 @@
+import os
+import sys
 import hashlib
-from cryptos.sha256 import sha256
-from cryptos.ripemd160 import ripemd160
+import subprocess
+from cryptos.sha256 import sha256, sha256_py, hash256, sha256_many, sha256d_64
+from cryptos.ripemd160 import ripemd160, ripemd160_py
 
 def test_sha256():
 
@@ -15,6 +18,37 @@ def test_sha256():
         gt = hashlib.sha256(b).hexdigest()
         yolo = sha256(b).hex()
         assert gt == yolo
+        yolo = sha256_py(b).hex()
+        assert gt == yolo
+
+def test_hash256():
+
+    for b in [b'', b'abc', b'hello'*100]:
+        gt = hashlib.sha256(hashlib.sha256(b).digest()).hexdigest()
+        assert hash256(b).hex() == gt
+
+def test_pure_py_sha_env():
+
+    # CRYPTOS_PURE_PY_SHA is read at import, so check it in a fresh interpreter
+    # (hashlib is knocked out after the import, so anything still using it would crash)
+    code = "import hashlib; from cryptos.sha256 import sha256, sha256_py, hash256, sha256_many, sha256d_64; " \
+           "assert sha256 is sha256_py; hashlib.sha256 = None; " \
+           "assert sha256_many([b'y'*5000, b'abc']) == [sha256_py(b'y'*5000), sha256_py(b'abc')]; " \
+           "assert sha256d_64([b'z'*64]) == [hash256(b'z'*64)]; " \
+           "print(hash256(b'abc').hex())"
+    env = dict(os.environ, CRYPTOS_PURE_PY_SHA='1')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', code], env=env, cwd=root, capture_output=True, check=True)
+    assert out.stdout.decode().strip() == hash256(b'abc').hex()
+
+def test_sha256_many():
+
+    msgs = [b'', b'abc', b'x'*64, b'y'*5000] # the last one is large enough to hit the thread pool
+    assert sha256_many(msgs) == [sha256(m) for m in msgs]
+    assert sha256_many(msgs[:3]) == [sha256(m) for m in msgs[:3]]
+
+    leaves = [bytes([i])*64 for i in range(5)]
+    assert sha256d_64(leaves) == [hash256(leaf) for leaf in leaves]
 
 def test_ripemd160():
 
@@ -33,3 +67,5 @@ def test_ripemd160():
     for b, gt in test_pairs:
         yolo = ripemd160(b.encode('ascii')).hex()
         assert gt == yolo
+        yolo = ripemd160_py(b.encode('ascii')).hex()
+        assert gt == yolo
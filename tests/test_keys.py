@@ -2,7 +2,7 @@
 Test the generation of secret/public keypairs and bitcoin addreses
 """
 
-from cryptos.keys import PublicKey, address_to_pkb_hash
+from cryptos.keys import PublicKey, address_to_pkb_hash, gen_key_pair, gen_key_pairs, _pk_from_sk
 from cryptos.bitcoin import BITCOIN
 
 def test_public_key_gen():
@@ -12,6 +12,8 @@ def test_public_key_gen():
     public_key = PublicKey.from_sk('1E99423A4ED27608A15A2616A2B0E9E52CED330AC530EDCC32C8FFC6A526AEDD')
     assert format(public_key.x, '064x').upper() == 'F028892BAD7ED57D2FB57BF33081D5CFCF6F9ED3D3D7F159C2E2FFF579DC341A'
     assert format(public_key.y, '064x').upper() == '07CF33DA18BD734C600B96A72BBC4749D5141C90EC8AC328AE52DDFE2E505BDB'
+    # derivations are memoized, also across the str / int forms of the same key
+    assert PublicKey.from_sk(0x1E99423A4ED27608A15A2616A2B0E9E52CED330AC530EDCC32C8FFC6A526AEDD) is public_key
 
 
 def test_btc_addresses():
@@ -67,3 +69,17 @@ def test_pk_sec():
         # decode
         P2 = PublicKey.decode(bytes.fromhex(sec))
         assert P.x == P2.x and P.y == P2.y
+
+def test_gen_key_pairs():
+
+    # fresh secret keys are not memoized by the from_sk cache
+    size = _pk_from_sk.cache_info().currsize
+    sk, pk = gen_key_pair()
+    assert _pk_from_sk.cache_info().currsize == size
+
+    pairs = gen_key_pairs(4, workers=2)
+    assert len(pairs) == 4
+    assert len(set(sk for sk, _ in pairs)) == 4
+    for sk, pk in pairs:
+        pk2 = PublicKey.from_sk(sk)
+        assert (pk.x, pk.y) == (pk2.x, pk2.y)
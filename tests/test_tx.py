@@ -4,15 +4,49 @@ Test Transaction
 
 from io import BytesIO
 
-from cryptos.transaction import Tx, TxIn, TxOut, Script
+import pytest
+
+from cryptos.transaction import Tx, TxIn, TxOut, Script, TxFetcher
 from cryptos.keys import PublicKey, address_to_pkb_hash
+from cryptos.sha256 import sha256
+from cryptos.ripemd160 import ripemd160
 from cryptos.ecdsa import sign
 
-def test_legacy_decode():
+# -----------------------------------------------------------------------------
+# the transactions used across the tests below, parsed from hex just once at import
+
+# Example taken from Programming Bitcoin, Chapter 5
+_RAW_LEGACY = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+# I snatched this transaction at random from the stream of transactions
+_RAW_SEGWIT = bytes.fromhex('010000000001026c4224e4d6bab0cfdfd67870e084cda34e42d3544b3c77d310df40831fa4f5061700000023220020fb24ee0fec024ff3ff03c44d16ca523b78fd33ebaab99176e98b3f5e0e78da9dffffffffe8faf73aee5a09b1b678277fc63150dff639c97521e9088d6721a2b995f33664010000002322002083e1adc1eb82945fa99500bcd9df963b0e731524fd8eb25ef205e88d3bd7ab77ffffffff03a0370a00000000001976a914b00ff32bbc990acde3e5ac022e6d4120fb168f1e88ac7f791300000000001976a914128afed7e8d4e6f3a9d2d38ad560c307ebf392ba88ac54115c00000000001976a914c65d16caa1d8c1c46cc1bfac92eff06b02d8afcc88ac04004830450221009d93dc766b4a3417d7daccffe39719cd0344779c19d589d3a078625139a7dcd50220267c1b9b365d0eaa3b036771cbfc994c2b1c5b29e5107f023f036360cb60c8b50147304402206346b5c2bfa243c9cd0c5056abedfadc79e4a2b67b918315fc3faf79dfd12d7602203f729a665afd02ceb4b07898c06c81f0dfc378f66409ed828a4b5fe84f9287550169522102b951c91d97118489d1980ec472d89b5bc98fb98d0bafa17aca238d18a758b8642103d45b78e2a683330c62878e44610a5d1c8d40bd1f261b1110940b1b8a5aecd3e82103796ecd1667be6e20af571c46517e4ecf5e83052df864266658dd7f88e63efa6153ae0400483045022100e396deff2fe6dd6081e35f9dced6e09ea1b8b4830ae322b5d58986596996893d0220485420653c118c1a13b48941166b242077530d2b3cab908abe67af6b96ef2850014730440220171e11f4d6a106464a94e29f46750803a7deb214e6fbe2140ec5d80577dded0e02203483ab0c685f66e17b4afa86ba053732b43ff1ca7654796e72b69bd224bf26c4016952210375e42f77749f92a6b54c8e85fab2209e6807e15a3768c024a5cab01dc301c0282103fd4969521bd2d0f8e147c16655ae9c29dc48cb4f124b7a6398db78b1cbc878a221036bc18f387d1e4ba80492854cee639bd4ab6e3a310d9faa6f17350bbdc4c029d053ae25680a00')
+_RAW_COINBASE = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000')
+
+# and as (raw bytes, decoded Tx) fixtures
+# note: a fresh Tx per test, since some of the tests mutate it
+
+@pytest.fixture
+def legacy_tx():
+    return _RAW_LEGACY, Tx.decode(BytesIO(_RAW_LEGACY))
+
+@pytest.fixture
+def segwit_tx():
+    return _RAW_SEGWIT, Tx.decode(BytesIO(_RAW_SEGWIT))
+
+@pytest.fixture
+def coinbase_tx():
+    return _RAW_COINBASE, Tx.decode(BytesIO(_RAW_COINBASE))
+
+def _flip_byte(b: bytes, i: int) -> bytes:
+    """ returns a copy of b with the byte at index i changed, to fudge signatures/keys """
+    ba = bytearray(b)
+    ba[i] = (ba[i] + 1) % 255
+    return bytes(ba)
+
+# -----------------------------------------------------------------------------
+
+def test_legacy_decode(legacy_tx):
 
-    # Example taken from Programming Bitcoin, Chapter 5
-    raw = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
-    tx = Tx.decode(BytesIO(raw))
+    raw, tx = legacy_tx
 
     # metadata parsing
     assert tx.version == 1
@@ -31,37 +65,43 @@ def test_legacy_decode():
     assert tx.locktime == 410393
     # id calculation
     assert tx.id() == '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03'
-    # fee calculation
-    assert tx.fee() == 40000
 
     # check correct decoding/encoding
     raw2 = tx.encode()
     assert raw == raw2
 
+# note: the tests below look up the previous transactions, so need the txdb cache or network
+
+def test_legacy_validate(legacy_tx):
+
+    _, tx = legacy_tx
+
+    # fee calculation
+    assert tx.fee() == 40000
+
     # validate the transaction as Bitcoin law-abiding and cryptographically authentic
     assert tx.validate()
 
+def test_legacy_fudge(legacy_tx):
+
+    _, tx = legacy_tx
+
     # fudge the r in the (r,s) digital signature tuple, this should break validation because CHECKSIG will fail
-    sigb = tx.tx_ins[0].script_sig.cmds[0]
-    sigb2 = sigb[:6] + bytes([(sigb[6] + 1) % 255]) + sigb[7:]
-    tx.tx_ins[0].script_sig.cmds[0] = sigb2
-    assert not tx.validate()
-    tx.tx_ins[0].script_sig.cmds[0] = sigb # revert to original
-    assert tx.validate()
+    sigb, pkb = tx.tx_ins[0].script_sig.cmds
+    sigb2 = _flip_byte(sigb, 6)
+    assert not tx.clone_with(0, Script([sigb2, pkb])).validate()
 
     # fudge the public key, should again break validation because pk hash won't match
-    pkb = tx.tx_ins[0].script_sig.cmds[1]
-    pkb2 = pkb[:6] + bytes([(pkb[6] + 1) % 255]) + pkb[7:]
-    tx.tx_ins[0].script_sig.cmds[1] = pkb2
-    assert not tx.validate()
-    tx.tx_ins[0].script_sig.cmds[1] = pkb # revert to original
+    pkb2 = _flip_byte(pkb, 6)
+    assert not tx.clone_with(0, Script([sigb, pkb2])).validate()
+
+    # the clones left the original transaction alone
+    assert tx.tx_ins[0].script_sig.cmds == [sigb, pkb]
     assert tx.validate()
 
-def test_segwit_decode():
+def test_segwit_decode(segwit_tx):
 
-    # I snatched this transaction at random from the stream of transactions
-    raw = bytes.fromhex('010000000001026c4224e4d6bab0cfdfd67870e084cda34e42d3544b3c77d310df40831fa4f5061700000023220020fb24ee0fec024ff3ff03c44d16ca523b78fd33ebaab99176e98b3f5e0e78da9dffffffffe8faf73aee5a09b1b678277fc63150dff639c97521e9088d6721a2b995f33664010000002322002083e1adc1eb82945fa99500bcd9df963b0e731524fd8eb25ef205e88d3bd7ab77ffffffff03a0370a00000000001976a914b00ff32bbc990acde3e5ac022e6d4120fb168f1e88ac7f791300000000001976a914128afed7e8d4e6f3a9d2d38ad560c307ebf392ba88ac54115c00000000001976a914c65d16caa1d8c1c46cc1bfac92eff06b02d8afcc88ac04004830450221009d93dc766b4a3417d7daccffe39719cd0344779c19d589d3a078625139a7dcd50220267c1b9b365d0eaa3b036771cbfc994c2b1c5b29e5107f023f036360cb60c8b50147304402206346b5c2bfa243c9cd0c5056abedfadc79e4a2b67b918315fc3faf79dfd12d7602203f729a665afd02ceb4b07898c06c81f0dfc378f66409ed828a4b5fe84f9287550169522102b951c91d97118489d1980ec472d89b5bc98fb98d0bafa17aca238d18a758b8642103d45b78e2a683330c62878e44610a5d1c8d40bd1f261b1110940b1b8a5aecd3e82103796ecd1667be6e20af571c46517e4ecf5e83052df864266658dd7f88e63efa6153ae0400483045022100e396deff2fe6dd6081e35f9dced6e09ea1b8b4830ae322b5d58986596996893d0220485420653c118c1a13b48941166b242077530d2b3cab908abe67af6b96ef2850014730440220171e11f4d6a106464a94e29f46750803a7deb214e6fbe2140ec5d80577dded0e02203483ab0c685f66e17b4afa86ba053732b43ff1ca7654796e72b69bd224bf26c4016952210375e42f77749f92a6b54c8e85fab2209e6807e15a3768c024a5cab01dc301c0282103fd4969521bd2d0f8e147c16655ae9c29dc48cb4f124b7a6398db78b1cbc878a221036bc18f387d1e4ba80492854cee639bd4ab6e3a310d9faa6f17350bbdc4c029d053ae25680a00')
-    tx = Tx.decode(BytesIO(raw))
+    raw, tx = segwit_tx
 
     # metadata parsing
     assert tx.version == 1
@@ -77,12 +117,19 @@ def test_segwit_decode():
     assert tx.tx_outs[2].amount == 6033748
     # id calculation
     assert tx.id() == '3ecf9b3d965cfaa2c472f09b5f487fbd838e4e1f861e3542c541d39c5cb7bc25'
-    assert tx.fee() == 31922
+    # the decoded objects are slotted, i.e. don't each carry around a __dict__
+    for obj in [tx, *tx.tx_ins, *tx.tx_outs, tx.tx_outs[0].script_pubkey]:
+        assert not hasattr(obj, '__dict__')
 
     # check correct decoding/encoding
     raw2 = tx.encode()
     assert raw == raw2
 
+def test_segwit_fee(segwit_tx):
+
+    _, tx = segwit_tx
+    assert tx.fee() == 31922
+
 def test_create_tx():
     # this example follows Programming Bitcoin Chapter 7
 
@@ -131,31 +178,87 @@ def test_create_tx():
     assert tx.validate()
 
     # peace of mind: fudge the signature and try again
-    der = der[:6] + bytes([(der[6] + 1) % 255]) + der[7:]
+    der = _flip_byte(der, 6)
     der_and_type = der + b'\x01'
     tx_in.script_sig = Script([der_and_type, sec])
     assert not tx.validate()
 
-def test_is_coinbase():
+def test_is_coinbase(legacy_tx, coinbase_tx):
 
     # not coinbase
-    raw = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
-    tx = Tx.decode(BytesIO(raw))
+    _, tx = legacy_tx
     assert not tx.is_coinbase()
 
     # is coinbase
-    raw = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000')
-    tx = Tx.decode(BytesIO(raw))
+    _, tx = coinbase_tx
     assert tx.is_coinbase()
     tx.tx_ins = [] # make not coinbase by deleting its inputs entirely
     assert not tx.is_coinbase()
 
-def test_coinbase_height():
+def test_coinbase_height(legacy_tx, coinbase_tx):
 
-    raw = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
-    tx = Tx.decode(BytesIO(raw))
+    _, tx = legacy_tx
     assert tx.coinbase_height() is None
 
-    raw = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000')
-    tx = Tx.decode(BytesIO(raw))
+    _, tx = coinbase_tx
     assert tx.coinbase_height() == 465879
+
+def test_script_push_lengths():
+
+    # 75 bytes is the longest direct push, 76 the shortest pushdata1, 256 the shortest pushdata2
+    for length, prefix in [(1, b'\x01'), (75, b'\x4b'), (76, b'\x4c\x4c'), (255, b'\x4c\xff'), (256, b'\x4d\x00\x01')]:
+        script = Script([118, b'\xab' * length])
+        raw = script.encode()
+        assert raw.endswith(b'\x76' + prefix + b'\xab' * length)
+        assert Script.decode(BytesIO(raw)) == script
+
+def test_tx_fetcher_cache(monkeypatch):
+
+    monkeypatch.setattr(TxFetcher, 'cache', type(TxFetcher.cache)())
+    monkeypatch.setattr(TxFetcher, 'cache_size', 2)
+    # the same tx id on different nets are different entries
+    TxFetcher.cache_put(('main', 'aa'), b'main tx')
+    TxFetcher.cache_put(('test', 'aa'), b'test tx')
+    assert TxFetcher.cache_get(('main', 'aa')) == b'main tx'
+    assert TxFetcher.cache_get(('test', 'aa')) == b'test tx'
+    # the least recently used entry is evicted once the cache is full
+    TxFetcher.cache_get(('main', 'aa'))
+    TxFetcher.cache_put(('main', 'bb'), b'another tx')
+    assert TxFetcher.cache_get(('test', 'aa')) is None
+    assert TxFetcher.cache_get(('main', 'aa')) == b'main tx'
+    assert len(TxFetcher.cache) == 2
+    # fetching goes through the memory cache before touching disk or network
+    TxFetcher.cache_put(('main', 'cc'), _RAW_LEGACY)
+    assert TxFetcher.fetch('CC', net='main').encode() == _RAW_LEGACY
+
+def test_tx_fetcher_pool(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(TxFetcher, 'cache', type(TxFetcher.cache)())
+    monkeypatch.setattr(TxFetcher, 'txdb_dir', str(tmp_path))
+    monkeypatch.setattr(TxFetcher, 'pool_size', 2)
+    monkeypatch.setattr(TxFetcher, '_pool', None)
+    sessions = set()
+    def load(tx_id, net):
+        sessions.add(id(TxFetcher.session()))
+        return bytes.fromhex(tx_id)
+    monkeypatch.setattr(TxFetcher, '_load', load)
+    # batch after batch runs on the same pool, so the worker sessions are reused
+    try:
+        for batch in range(3):
+            TxFetcher.fetch_many(['%02x%02x' % (batch, i) for i in range(4)], net='main')
+        assert len(sessions) <= 2
+        assert len(TxFetcher.cache) == 12
+    finally:
+        TxFetcher.pool().shutdown()
+
+def test_evaluate_malformed_pubkey(legacy_tx):
+
+    _, tx = legacy_tx
+    sigb, pkb = tx.tx_ins[0].script_sig.cmds
+    p2pkh = lambda h: Script([118, 169, h, 136, 172]) # OP_DUP, OP_HASH160, <hash>, OP_EQUALVERIFY, OP_CHECKSIG
+    msg = b'the message does not matter, these must all fail before OP_CHECKSIG'
+    for bad in [b'', b'\x02' + b'\xab' * 39, pkb[:-1], pkb + b'\x00', b'\x05' + pkb[1:]]:
+        # the pubkey hash of the real key won't match, and neither will a correct looking hash
+        # of bytes that aren't a valid SEC encoding. Either way no exceptions, just invalid.
+        assert (Script([sigb, bad]) + p2pkh(ripemd160(sha256(pkb)))).evaluate(msg) is False
+        assert (Script([sigb, bad]) + p2pkh(ripemd160(sha256(bad)))).evaluate(msg) is False